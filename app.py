@@ -8,10 +8,13 @@ import sys
 import constants
 import dash_bootstrap_components as dbc
 import tasks
+import store
+import mission_config
 
 import diskcache
 
-from celery import Celery
+from celery import Celery, chord, group, uuid
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.schedules import crontab
 from celery.utils.log import get_task_logger
 
@@ -30,8 +33,67 @@ else:
 
 
 @celery_app.task
-def run_update():
-    tasks.load_missions()
+def run_update(full=False, force=False):
+    # Fan out one task per mission so the whole worker pool shares the ingest, then publish
+    # the combined locations once every mission has either finished or given up.
+    # Use force=True to re-read frozen missions and unchanged drones.
+    full = tasks.is_full_load(incremental=not full)
+    mission_updates = []
+    task_ids = []
+    for mid, mission in tasks.list_missions():
+        task_id = uuid()
+        mission_updates.append(update_mission.s(mid, mission, full, force).set(task_id=task_id))  # pyright: ignore[reportFunctionMemberAccess]
+        task_ids.append([mid, task_id])
+    # A mission task that dies anyway (e.g. killed at the hard time limit) fails the chord, and
+    # then publish_partial publishes the missions that did finish.
+    publish = publish_update.s(full).on_error(publish_partial.si(task_ids, full))                 # pyright: ignore[reportFunctionMemberAccess]
+    chord(group(mission_updates), publish).apply_async()
+
+
+# A slow ERDDAP server only delays its own mission. Past the soft limit the task gives up
+# and reports the mission as failed; the hard limit is there in case that doesn't happen.
+# Drone reads already in flight when the soft limit hits are abandoned rather than stopped,
+# they finish in the background within constants.erddap_timeout of their last response.
+@celery_app.task(soft_time_limit=constants.mission_task_timeout, time_limit=constants.mission_task_timeout + 60)
+def update_mission(mid, mission, full, force=False):
+    try:
+        return tasks.ingest_mission(mid, mission, full, force=force)
+    except SoftTimeLimitExceeded:
+        logger.warning('Mission ' + mid + ' timed out after ' + str(constants.mission_task_timeout) + ' seconds.')
+        return {'mission_id': mid, 'ok': False, 'error': 'Timed out after ' + str(constants.mission_task_timeout) + ' seconds'}
+    except Exception as e:
+        logger.exception('Failed to update mission ' + mid)
+        return {'mission_id': mid, 'ok': False, 'error': repr(e)}
+
+
+@celery_app.task
+def publish_update(results, full):
+    report = tasks.publish_locations(results, full)
+    # Then bring the local full resolution store up to date with the missions we just read.
+    group(sync_store.s(mid) for mid in report['succeeded']).apply_async()     # pyright: ignore[reportFunctionMemberAccess]
+    return report
+
+
+@celery_app.task
+def publish_partial(task_ids, full):
+    # The chord failed, so collect what each mission task left and publish that,
+    # with the missions whose task failed reported as failed.
+    results = []
+    for mid, task_id in task_ids:
+        result = celery_app.AsyncResult(task_id)
+        if result.successful() and isinstance(result.result, dict):
+            results.append(result.result)
+        else:
+            results.append({'mission_id': mid, 'ok': False, 'error': 'Task ' + str(result.state) + ': ' + repr(result.result)})
+    return publish_update(results, full)
+
+
+@celery_app.task(soft_time_limit=constants.store_task_timeout, time_limit=constants.store_task_timeout + 60)
+def sync_store(mid):
+    mission = mission_config.get(mid)
+    if mission is None:
+        return 0
+    return store.sync_mission(mid, mission)
 
 #
 # !!!!!!!!!!
@@ -80,7 +142,6 @@ server = app.server  # expose server variable for Procfile
 
 app.layout = ddk.App(show_editor=False, theme=constants.theme, children=[
     dcc.Location(id='url', refresh=False),
-    dcc.Store(id='plots-trigger'),
     dcc.Store(id='trace-trigger'),
     ddk.Sidebar(
         children=[
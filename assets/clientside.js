@@ -0,0 +1,153 @@
+// Callbacks of the mission page that only move values between controls, run in the browser
+// so they don't take a trip to the server. They are registered in pages/mission.py.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    saildrone: {
+
+        // The query string of the page for the current choices, so the page can be bookmarked.
+        set_search: function(drone,
+                             trace_decimation,
+                             trace_variable,
+                             plots_decimation,
+                             plot_variables,
+                             selected_start_date,
+                             selected_end_date,
+                             num_plot_cols,
+                             plot_mode,
+                             plots_per,
+                             state_search) {
+            let s = '';
+            if (state_search) {
+                const mission_id = new URLSearchParams(state_search.substring(1)).get('mission_id');
+                if (mission_id !== null) {
+                    s = '?mission_id=' + mission_id;
+                }
+            }
+
+            if (drone !== null && drone !== undefined) {
+                if (Array.isArray(drone)) {
+                    for (const d of drone) {
+                        s = s + '&drone=' + d;
+                    }
+                } else if (typeof drone === 'string') {
+                    s = s + '&drone=' + drone;
+                }
+            }
+            if (trace_decimation !== null && trace_decimation !== undefined) {
+                s = s + (s.length === 1 ? '' : '&') + 'trace_decimation=' + String(trace_decimation);
+            }
+            if (trace_variable !== null && trace_variable !== undefined) {
+                s = s + (s.length === 1 ? '' : '&') + 'trace_variable=' + trace_variable;
+            }
+            if (plots_decimation !== null && plots_decimation !== undefined) {
+                s = s + (s.length === 1 ? '' : '&') + 'plots_decimation=' + String(plots_decimation);
+            }
+            if (plot_variables !== null && plot_variables !== undefined) {
+                if (Array.isArray(plot_variables)) {
+                    for (const ts of plot_variables) {
+                        s = s + (s.length === 1 ? '' : '&') + 'timeseries=' + ts;
+                    }
+                } else if (typeof plot_variables === 'string') {
+                    s = s + '&timeseries=' + plot_variables;
+                }
+            }
+
+            if (selected_start_date && selected_start_date.length > 0) {
+                s = s + '&start_date=' + selected_start_date;
+            }
+            if (selected_end_date && selected_end_date.length > 0) {
+                s = s + '&end_date=' + selected_end_date;
+            }
+
+            if (num_plot_cols !== null && num_plot_cols !== undefined) {
+                s = s + '&columns=' + String(num_plot_cols);
+            }
+            if (plot_mode !== null && plot_mode !== undefined) {
+                s = s + '&mode=' + plot_mode;
+            }
+
+            if (plots_per !== null && plots_per !== undefined) {
+                let pp_value = 'all';
+                if (Array.isArray(plots_per) && plots_per.length > 0) {
+                    pp_value = plots_per[0];
+                }
+                s = s + (s.length === 1 ? '' : '&') + 'plots_per=' + String(pp_value);
+            }
+
+            if (s.length === 1) {
+                return ['', false];
+            }
+            return [s, false];
+        },
+
+        // Keep the time slider and the start and end date inputs in step, with the dates kept
+        // inside the mission and in order. Dates are days in UTC, the slider is in seconds.
+        set_date_range_from_slider: function(slide_values, in_start_date, in_end_date, range_min, range_max) {
+            if (slide_values === null || slide_values === undefined) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+
+            const day_seconds = function(text) {
+                // Seconds of a yyyy-mm-dd date, or null if it isn't one.
+                const match = /^(\d{4})-(\d{1,2})-(\d{1,2})$/.exec(text || '');
+                if (match === null) {
+                    return null;
+                }
+                const year = Number(match[1]);
+                const month = Number(match[2]);
+                const day = Number(match[3]);
+                const date = new Date(Date.UTC(year, month - 1, day));
+                if (date.getUTCFullYear() !== year || date.getUTCMonth() !== month - 1 || date.getUTCDate() !== day) {
+                    return null;
+                }
+                return date.getTime() / 1000;
+            };
+            const day_text = function(seconds) {
+                return new Date(seconds * 1000).toISOString().substring(0, 10);
+            };
+
+            const trigger_id = window.dash_clientside.callback_context.triggered[0].prop_id.split('.')[0];
+
+            let start_seconds = slide_values[0];
+            let end_seconds = slide_values[1];
+
+            let start_output = in_start_date;
+            let end_output = in_end_date;
+
+            if (trigger_id === 'start-date') {
+                let seconds = day_seconds(in_start_date);
+                if (seconds === null) {
+                    seconds = start_seconds;
+                }
+                start_seconds = seconds;
+                if (start_seconds < range_min) {
+                    start_seconds = range_min;
+                } else if (start_seconds > range_max) {
+                    start_seconds = range_max;
+                } else if (start_seconds > end_seconds) {
+                    start_seconds = end_seconds;
+                }
+                start_output = day_text(start_seconds);
+            } else if (trigger_id === 'end-date') {
+                let seconds = day_seconds(in_end_date);
+                if (seconds === null) {
+                    seconds = end_seconds;
+                }
+                end_seconds = seconds;
+                if (end_seconds < range_min) {
+                    end_seconds = range_min;
+                } else if (end_seconds > range_max) {
+                    end_seconds = range_max;
+                } else if (end_seconds < start_seconds) {
+                    end_seconds = start_seconds;
+                }
+                end_output = day_text(end_seconds);
+            } else if (trigger_id === 'time-range-slider') {
+                start_output = day_text(slide_values[0]);
+                end_output = day_text(slide_values[1]);
+            }
+
+            return [[start_seconds, end_seconds], start_output, end_output];
+        }
+    }
+});
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from plotly.subplots import make_subplots
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import plot_grid
+
+# Time to build the time series plots figure of the mission page for 1 to 100 subplots, the way
+# draw_plots did it with make_subplots, add_trace and update_xaxes/update_yaxes/legend for every
+# plot, and with plot_grid.grid_figure. Each subplot has one trace of 1,000 points.
+#
+#     python benchmarks/bench_subplots.py [columns] [repeats]
+
+line_rgb = 'rgba(.04,.04,.04,.05)'
+counts = [1, 2, 5, 10, 20, 50, 100]
+
+
+def traces(n):
+    times = pd.date_range('2024-01-01', periods=1000, freq='1h', tz='UTC')
+    values = np.random.default_rng(0).normal(size=1000).cumsum()
+    return [{'type': 'scattergl', 'x': times, 'y': values, 'name': 'drone ' + str(i), 'mode': 'lines',
+             'hoverinfo': 'x+y+name', 'showlegend': True, 'legendgroup': 'drone ' + str(i)} for i in range(n)]
+
+
+def grid(n, columns):
+    cols = min(n, columns)
+    rows = (n + cols - 1) // cols
+    return rows, cols, [1 / rows] * rows, ['plot ' + str(i) for i in range(n)]
+
+
+def with_make_subplots(n, columns):
+    rows, cols, row_heights, titles = grid(n, columns)
+    figure = make_subplots(rows=rows, cols=cols, shared_xaxes='all', subplot_titles=titles,
+                           shared_yaxes=False, row_heights=row_heights)
+    for k, trace in enumerate(traces(n)):
+        figure.add_trace(trace, row=k // cols + 1, col=k % cols + 1)
+        figure.update_xaxes({'showticklabels': True, 'gridcolor': line_rgb})
+        figure.update_yaxes({'gridcolor': line_rgb})
+        figure.layout['legend'] = {'yref': 'paper', 'y': 1.3, 'xref': 'paper', 'x': .1, 'orientation': 'h'}
+    return figure
+
+
+def with_plot_grid(n, columns):
+    rows, cols, row_heights, titles = grid(n, columns)
+    figure = plot_grid.grid_figure([[trace] for trace in traces(n)], rows, cols, titles=titles, row_heights=row_heights,
+                                   xaxis={'showticklabels': True, 'gridcolor': line_rgb},
+                                   yaxis={'gridcolor': line_rgb})
+    figure['layout']['legend'] = {'yref': 'paper', 'y': 1.3, 'xref': 'paper', 'x': .1, 'orientation': 'h'}
+    return figure
+
+
+def best(build, n, columns, repeats):
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        build(n, columns)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+if __name__ == '__main__':
+    columns = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # The template is made once per process, like in the app.
+    plot_grid.template()
+    print(f'{"subplots":>8} {"make_subplots s":>16} {"plot_grid s":>12} {"speedup":>8}')
+    for n in counts:
+        old = best(with_make_subplots, n, columns, repeats)
+        new = best(with_plot_grid, n, columns, repeats)
+        print(f'{n:>8} {old:>16.4f} {new:>12.4f} {old / new:>7.0f}x')
@@ -1,28 +1,277 @@
+import os
+import json
+import time
+import socket
+import threading
+import contextlib
+import collections
 import constants
 import pandas as pd
 import datetime
+from sqlalchemy import create_engine, text, bindparam
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
+# The engine and its connection pool belong to the process that made them. A process forked
+# from one that already had an engine (gunicorn --preload, the celery prefork pool) notices the
+# new pid and makes its own, so no two processes ever talk over the same socket.
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
 
-def get_locations():
+# The redis key of the locations table generation, see mission_frame().
+generation_key = 'locations_generation'
+
+# Pool counters for this process, see pool_stats().
+_stats = {}
+_stats_lock = threading.Lock()
+_stats_published = 0
+
+
+def _reset_stats():
+    global _stats_published
+    _stats.clear()
+    _stats.update({
+        'checkouts': 0,
+        'saturated': 0,
+        'timeouts': 0,
+        'checkout_seconds': 0.0,
+        'checkout_max_seconds': 0.0,
+    })
+    _stats_published = 0
+
+
+def engine():
+    global _engine, _engine_pid
+    pid = os.getpid()
+    if _engine_pid != pid:
+        with _engine_lock:
+            if _engine_pid != pid:
+                if _engine is not None:
+                    # Inherited from the parent, let go of its connections without closing them.
+                    _engine.dispose(close=False)
+                _engine = create_engine(
+                    constants.connection_string,
+                    pool_size=constants.postgres_pool_size,
+                    max_overflow=constants.postgres_max_overflow,
+                    pool_timeout=constants.postgres_pool_timeout,
+                    pool_recycle=constants.postgres_pool_recycle,
+                    pool_pre_ping=True,
+                )
+                _engine_pid = pid
+                _reset_stats()
+    return _engine
+
+
+def _checkout(get):
+    # Time how long it takes the pool to hand over a connection, and count the checkouts
+    # that found every connection busy (they wait for one to come back).
+    pool = engine().pool
+    saturated = pool.checkedout() >= constants.postgres_pool_size + constants.postgres_max_overflow
+    start = time.perf_counter()
+    try:
+        conn = get()
+    except PoolTimeoutError:
+        with _stats_lock:
+            _stats['timeouts'] += 1
+        publish_pool_stats(force=True)
+        raise
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _stats['checkouts'] += 1
+        _stats['saturated'] += int(saturated)
+        _stats['checkout_seconds'] += elapsed
+        _stats['checkout_max_seconds'] = max(_stats['checkout_max_seconds'], elapsed)
+    publish_pool_stats()
+    return conn
+
+
+@contextlib.contextmanager
+def connect():
+    # A pooled SQLAlchemy connection, given back to the pool at the end of the with block.
+    conn = _checkout(lambda: engine().connect())
+    with conn:
+        yield conn
+
+
+def raw_connection():
+    # A pooled DBAPI connection for COPY and explicit transactions. close() gives it back to the pool.
+    return _checkout(lambda: engine().raw_connection())
+
+
+def pool_stats():
+    pool = engine().pool
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update({
+        'pid': os.getpid(),
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'checkout_mean_seconds': stats['checkout_seconds'] / stats['checkouts'] if stats['checkouts'] > 0 else 0.0,
+    })
+    return stats
+
+
+def publish_pool_stats(force=False):
+    # Every process's counters are kept in redis under postgres_pool:<host>:<pid>. The key expires
+    # a few intervals after the process stops updating it, so recycled workers don't linger.
+    global _stats_published
+    now = time.monotonic()
+    if not force and now - _stats_published < constants.pool_stats_interval:
+        return
+    _stats_published = now
+    try:
+        constants.redis_instance.set('postgres_pool:' + socket.gethostname() + ':' + str(os.getpid()), json.dumps(pool_stats()),
+                                     ex=3 * constants.pool_stats_interval)
+    except Exception:
+        # The counters are not worth failing a query over.
+        pass
+
+
+def get_locations(columns=None):
     # In this function, we retrieve the data from postgres using pandas's read_sql method.
 
     # This data is periodically getting updated via a separate Celery Process in tasks.py.
     # "dataset_table" is the name of the table that we initialized in tasks.py.
 
-    updated_df = pd.read_sql(
-        "SELECT * FROM {};".format(constants.locations_table), constants.postgres_engine
-    )
+    with connect() as conn:
+        updated_df = pd.read_sql(
+            text("SELECT {} FROM {};".format(select_list(columns), constants.locations_table)), conn
+        )
     return updated_df
 
-def get_mission_locations(mission_id, dsg_id):
+def get_mission_locations(mission_id, dsg_id, start_date=None, end_date=None, drones=None, columns=None):
+    # The locations of a mission, trimmed to a time range, some of the drones and some of the columns.
+    # Served from the cached frame of the whole mission (see mission_frame).
+    df = mission_frame(mission_id, dsg_id)
+    if df is None:
+        return query_mission_locations(mission_id, dsg_id, start_date, end_date, drones, columns)
+    keep = pd.Series(True, index=df.index)
+    if drones is not None:
+        keep = keep & df[dsg_id].isin(list(drones))
+    if start_date is not None:
+        keep = keep & (df['time'] >= utc(start_date))
+    if end_date is not None:
+        keep = keep & (df['time'] <= utc(end_date))
+    if columns is not None:
+        return df.loc[keep, list(columns)].reset_index(drop=True)
+    return df.loc[keep].reset_index(drop=True)
+
+def query_mission_locations(mission_id, dsg_id, start_date=None, end_date=None, drones=None, columns=None):
     # In this function, we retrieve the data from postgres using pandas's read_sql method.
 
     # This data is periodically getting updated via a separate Celery Process in tasks.py.
     # "dataset_table" is the name of the table that we initialized in tasks.py.
-    updated_df = pd.read_sql(
-        "SELECT * FROM {} WHERE MISSION_ID=\'{}\' ORDER BY TIME,{};".format(constants.locations_table, mission_id, dsg_id), constants.postgres_engine
-    )
+
+    # Only the rows and columns that are going to be shown are read. The filters are all
+    # covered by the (mission_id, trajectory, time) index the ingest builds.
+    sql = "SELECT {} FROM {} WHERE mission_id = :mission_id".format(select_list(columns), constants.locations_table)
+    params = {'mission_id': mission_id}
+    bind = []
+    if drones is not None:
+        sql = sql + " AND {} IN :drones".format(identifier(dsg_id))
+        params['drones'] = list(drones)
+        bind.append(bindparam('drones', expanding=True))
+    if start_date is not None:
+        sql = sql + " AND time >= :start_date"
+        params['start_date'] = utc(start_date)
+    if end_date is not None:
+        sql = sql + " AND time <= :end_date"
+        params['end_date'] = utc(end_date)
+    sql = sql + " ORDER BY time,{};".format(identifier(dsg_id))
+    with connect() as conn:
+        updated_df = pd.read_sql(text(sql).bindparams(*bind), conn, params=params)
     return updated_df
 
+def get_mission_time_range(mission_id, dsg_id='trajectory'):
+    # First and last location time of a mission.
+    df = mission_frame(mission_id, dsg_id)
+    if df is not None:
+        return utc(df['time'].min()), utc(df['time'].max())
+    with connect() as conn:
+        time_range = pd.read_sql(
+            text("SELECT MIN(time) AS start_date, MAX(time) AS end_date FROM {} WHERE mission_id = :mission_id;".format(constants.locations_table)),
+            conn, params={'mission_id': mission_id}
+        )
+    return utc(time_range['start_date'].iloc[0]), utc(time_range['end_date'].iloc[0])
+
+def get_location_summary(mission_ids):
+    # Time extent, number of rows and bounding box of each drone of the missions.
+    sql = ("SELECT mission_id, trajectory, MIN(time) AS start_date, MAX(time) AS end_date, COUNT(*) AS row_count,"
+           " MIN(longitude) AS west, MIN(latitude) AS south, MAX(longitude) AS east, MAX(latitude) AS north"
+           " FROM {} WHERE mission_id IN :mission_ids GROUP BY mission_id, trajectory;").format(constants.locations_table)
+    with connect() as conn:
+        summary = pd.read_sql(text(sql).bindparams(bindparam('mission_ids', expanding=True)), conn,
+                              params={'mission_ids': list(mission_ids)})
+    return summary
+
+# Every process keeps the location frames of the missions it was asked for most recently, up to
+# constants.locations_cache_mb. The frames are keyed by mission and the generation of the locations
+# table, a counter in redis the ingest bumps whenever it changes the table, so a process goes back
+# to postgres for a mission on the first request after the data changed. Missions too big for the
+# cache are remembered for the generation too, so they go straight to the query rather than being
+# read whole again on every request.
+_frames = collections.OrderedDict()
+_frames_bytes = 0
+_oversize = set()
+_frames_lock = threading.Lock()
+
+
+def generation():
+    value = constants.redis_instance.get(generation_key)
+    return int(value) if value is not None else 0
+
+
+def bump_generation():
+    return constants.redis_instance.incr(generation_key)
+
+
+def mission_frame(mission_id, dsg_id='trajectory'):
+    # The whole mission, ordered by time and dsg_id, or None when it doesn't fit in the cache.
+    # The frame is shared, callers must not change it.
+    global _frames_bytes
+    key = (mission_id, dsg_id, generation())
+    with _frames_lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key][0]
+        if key in _oversize:
+            return None
+    df = query_mission_locations(mission_id, dsg_id)
+    size = int(df.memory_usage(deep=True).sum())
+    limit = constants.locations_cache_mb * 1024 * 1024
+    with _frames_lock:
+        # Frames of an older generation will never be asked for again.
+        for stale in [k for k in _oversize if k[2] != key[2]]:
+            _oversize.discard(stale)
+        if size > limit:
+            _oversize.add(key)
+            return None
+        for stale in [k for k in _frames if k[2] != key[2] or k == key]:
+            _frames_bytes -= _frames.pop(stale)[1]
+        _frames[key] = (df, size)
+        _frames_bytes += size
+        while _frames_bytes > limit:
+            _, (_, evicted) = _frames.popitem(last=False)
+            _frames_bytes -= evicted
+    return df
+
+def select_list(columns):
+    if columns is None:
+        return '*'
+    return ','.join(identifier(c) for c in columns)
+
+def identifier(name):
+    # Column names are put into the SQL text, so only plain names are allowed.
+    if not name.isidentifier():
+        raise ValueError('Not a column name: ' + str(name))
+    return name
+
+def utc(value):
+    t = pd.Timestamp(value)
+    if t.tzinfo is None:
+        t = t.tz_localize('UTC')
+    return t.tz_convert('UTC')
+
 def drop():
-    "DROP {}".format(constants.locations_table)
\ No newline at end of file
+    "DROP {}".format(constants.locations_table)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from tsdownsample import NaNMinMaxLTTBDownsampler
+
+# Shape preserving downsampling for the traces of the mission page. MinMaxLTTB keeps the
+# minimum and maximum of every stretch of the data and then picks among them the points that
+# best keep the shape of the line, so peaks survive and the same data always gives the same points.
+
+
+def numbers(values):
+    # The x values as numbers, times as microseconds since 1970.
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float64)
+    times = pd.to_datetime(values, utc=True)
+    return ((times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)).to_numpy(dtype=np.int64)
+
+
+def downsample(df, x, y, n_out):
+    # The rows of df, in x order, that MinMaxLTTB keeps to draw y against x with n_out points.
+    df = df.sort_values(x, kind='stable')
+    n_out = max(int(n_out), 4)
+    if df.shape[0] <= n_out:
+        return df
+    xs = numbers(df[x])
+    ys = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    index = NaNMinMaxLTTBDownsampler().downsample(xs, ys, n_out=n_out)
+    return df.iloc[np.sort(index.astype(np.int64))]
+
+
+def gap_ends(df, x, columns, freq):
+    # For each of the columns, the x values that follow a gap in that column's data: more than
+    # two intervals of freq since the previous row where the column has a value, so a single
+    # missing sample doesn't break the line but a longer outage (of the drone or of just that
+    # sensor) does. All the columns are done in one pass over df, which must be sorted by x.
+    xs = numbers(df[x])
+    step = pd.Timedelta(freq) // pd.Timedelta(microseconds=1)
+    has_value = df[columns].notna().to_numpy()
+    held = np.where(has_value, xs[:, None].astype(np.float64), np.nan)
+    # The x of the previous value of each column, row by row.
+    previous = pd.DataFrame(held).ffill().shift(1).to_numpy()
+    with np.errstate(invalid='ignore'):
+        gap = has_value & (xs[:, None] - previous > 2 * step)
+    return {column: xs[gap[:, j]] for j, column in enumerate(columns)}
+
+
+def insert_gaps(df, x, ends):
+    # df, sorted by x, with a row of NaN in front of every gap end so the lines are broken
+    # there. The x of the new rows is the x of the gap end, every other column is NaN.
+    xs = numbers(df[x])
+    at = np.unique(np.searchsorted(xs, ends))
+    at = at[(at > 0) & (at < df.shape[0])]
+    if at.shape[0] == 0:
+        return df
+    rows = np.insert(np.arange(df.shape[0]), at, at)
+    gap = np.zeros(rows.shape[0], dtype=bool)
+    gap[at + np.arange(at.shape[0])] = True
+    out = df.iloc[rows].reset_index(drop=True)
+    out.loc[gap, [c for c in df.columns if c != x]] = np.nan
+    return out
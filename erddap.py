@@ -0,0 +1,216 @@
+import io
+import json
+import random
+import threading
+import time
+import uuid
+import urllib.parse
+import urllib.error
+import urllib.request
+import pandas as pd
+from sdig.erddap.info import Info
+import constants
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+# One semaphore per ERDDAP server (host:port) shared through redis by every thread of every
+# process, web and celery workers alike, so all of them together never have more than
+# constants.erddap_host_limit requests outstanding against the same server. The holders of
+# a server's slots are a sorted set by the time they took them. A process that dies holding
+# a slot loses it after constants.erddap_slot_lease seconds.
+_acquire_slot = constants.redis_instance.register_script('''
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+''')
+
+
+class host_slot:
+
+    def __init__(self, url):
+        self.key = 'erddap_slots:' + urllib.parse.urlparse(url).netloc
+        self.token = uuid.uuid4().hex
+
+    def __enter__(self):
+        while not _acquire_slot(keys=[self.key], args=[time.time(), constants.erddap_slot_lease, constants.erddap_host_limit, self.token]):
+            time.sleep(0.1 + 0.1 * random.random())
+        return self
+
+    def __exit__(self, *exc):
+        constants.redis_instance.zrem(self.key, self.token)
+        return False
+
+
+def metadata_key(url):
+    return 'erddap_metadata:' + url
+
+
+def get_metadata(url, refresh=False):
+    # Dataset metadata from ERDDAP's info service, cached in redis for constants.metadata_ttl
+    # seconds since variable lists, names, units and DSG ids almost never change.
+    key = metadata_key(url)
+    if not refresh:
+        cached = constants.redis_instance.get(key)
+        if cached is not None:
+            return json.loads(cached)
+    with host_slot(url):
+        info = read_info(url)
+        depth_name, dsg_var = info.get_dsg_info()
+        dsg_type = info.get_dsg_type()
+        variables, long_names, units, standard_names, var_types = info.get_variables()
+    metadata = {
+        'depth_name': depth_name,
+        'dsg_var': dsg_var,
+        'dsg_type': dsg_type,
+        'variables': variables,
+        'long_names': long_names,
+        'units': units,
+        'standard_names': standard_names,
+        'var_types': var_types,
+    }
+    constants.redis_instance.set(key, json.dumps(metadata), ex=constants.metadata_ttl)
+    return metadata
+
+
+def read_info(url):
+    # Info(url) reads the dataset's info without a timeout of its own, so wait for it at most
+    # constants.erddap_timeout. A read that hangs is left to finish in the background, but
+    # gives its host slot back.
+    result = {}
+
+    def read():
+        try:
+            result['info'] = Info(url)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    thread.join(constants.erddap_timeout)
+    if thread.is_alive():
+        raise TimeoutError('No info from ' + url + ' in ' + str(constants.erddap_timeout) + ' seconds')
+    if 'error' in result:
+        raise result['error']
+    return result['info']
+
+
+def invalidate_metadata(url=None):
+    # Forget the cached metadata for one dataset, or for all of them.
+    if url is not None:
+        constants.redis_instance.delete(metadata_key(url))
+    else:
+        for key in constants.redis_instance.scan_iter(metadata_key('*')):
+            constants.redis_instance.delete(key)
+
+
+# Reading tabledap responses. read_table asks for the formats in constants.erddap_formats in
+# order and decodes the first one the server can produce, with .csv0 as the last resort.
+# Whatever the format, the result has typed columns and a UTC time column.
+
+time_format = '%Y-%m-%dT%H:%M:%SZ'
+
+# ERDDAP data types to pandas dtypes for the csv decoder. Floats are read as float64 so the
+# values are the ones printed in the csv.
+pandas_types = {
+    'double': 'float64',
+    'float': 'float64',
+    'long': 'Int64',
+    'int': 'Int32',
+    'short': 'Int16',
+    'byte': 'Int8',
+    'ulong': 'UInt64',
+    'uint': 'UInt32',
+    'ushort': 'UInt16',
+    'ubyte': 'UInt8',
+    'boolean': 'boolean',
+    'char': 'str',
+    'String': 'str',
+}
+
+# (host, format) pairs a server has said it can't produce, so they are not asked for again.
+_unsupported = set()
+
+
+def format_time(t):
+    return pd.Timestamp(t).strftime(time_format)
+
+
+def time_strings(times):
+    return pd.to_datetime(times, utc=True).dt.strftime(time_format)
+
+
+def utc_times(times):
+    if pd.api.types.is_numeric_dtype(times):
+        # seconds since 1970, ERDDAP's own time units
+        return pd.to_datetime(times, unit='s', utc=True)
+    return pd.to_datetime(times, utc=True)
+
+
+def decode_csv(data, variables, var_types):
+    # .csv0 has no names or units rows, so pyarrow reads it straight through using the types
+    # Info.get_variables() already gave us instead of inferring them from the text.
+    dtype = {}
+    for var in variables:
+        if var != 'time' and var_types.get(var) in pandas_types:
+            dtype[var] = pandas_types[var_types[var]]
+    return pd.read_csv(io.BytesIO(data), names=variables, header=None, engine='pyarrow', dtype=dtype)
+
+
+def decode_parquet(data, variables, var_types):
+    return pd.read_parquet(io.BytesIO(data), columns=variables)
+
+
+def decode_nc(data, variables, var_types):
+    ds = xr.open_dataset(io.BytesIO(data))
+    df = ds[variables].to_dataframe().reset_index(drop=True)
+    for var in variables:
+        if df[var].dtype == object:
+            df[var] = df[var].map(lambda v: v.decode('utf-8') if isinstance(v, bytes) else v)
+    return df
+
+
+decoders = {
+    'parquet': decode_parquet,
+    'nc': decode_nc,
+    'csv0': decode_csv,
+}
+
+
+def fetch(url):
+    with host_slot(url):
+        with urllib.request.urlopen(url, timeout=constants.erddap_timeout) as response:
+            return response.read()
+
+
+def read_table(dataset_url, variables, query='', var_types=None):
+    # The rows of a tabledap query for the variables, with the constraints and filters in query
+    # (e.g. '&trajectory="1005.0"&orderBy("time")'). Raises urllib.error.HTTPError with code 404
+    # when nothing matches, like reading the csv did.
+    if var_types is None:
+        var_types = {}
+    host = urllib.parse.urlparse(dataset_url).netloc
+    formats = [f for f in constants.erddap_formats if f in decoders and f != 'csv0'] + ['csv0']
+    for file_type in formats:
+        if (host, file_type) in _unsupported:
+            continue
+        if file_type == 'nc' and xr is None:
+            continue
+        url = dataset_url + '.' + file_type + '?' + ','.join(variables) + urllib.parse.quote(query, safe='&()=:/')
+        try:
+            data = fetch(url)
+        except urllib.error.HTTPError as e:
+            if file_type != 'csv0' and e.code == 400 and 'fileType' in e.read().decode('utf-8', 'replace'):
+                _unsupported.add((host, file_type))
+                continue
+            raise
+        df = decoders[file_type](data, variables, var_types)
+        if 'time' in df.columns:
+            df['time'] = utc_times(df['time'])
+        return df
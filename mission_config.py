@@ -0,0 +1,86 @@
+import json
+import threading
+import types
+import msgpack
+import zstandard
+import constants
+
+# The configuration and metadata of every mission lives in the "mission" redis hash, and the
+# "mission_version" hash counts the times each one has been written. Readers get the mission
+# from get(), which keeps the decoded mission in memory, read only, and only fetches and decodes
+# it again when its version has changed: one HGET of a small number per call. Anything that
+# changes a mission must load() it and put() it back so the version moves.
+#
+# constants.mission_codec picks how the missions are stored: json, msgpack or msgpack+zstd.
+# Every process can read all three whatever its own setting, so the setting can be changed at any time.
+
+mission_key = 'mission'
+version_key = 'mission_version'
+
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+_missions = {}
+_missions_lock = threading.Lock()
+
+
+def encode(mission):
+    codec = constants.mission_codec
+    if codec.startswith('msgpack'):
+        data = msgpack.packb(mission, use_bin_type=True)
+        if codec == 'msgpack+zstd':
+            data = zstandard.ZstdCompressor().compress(data)
+        return data
+    return json.dumps(mission)
+
+
+def decode(data):
+    if data[:4] == zstd_magic:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    if data[:1] == b'{':
+        return json.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def freeze(value):
+    # A read only view of a decoded mission, dicts become mappingproxy and lists tuples.
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def version(mid):
+    value = constants.redis_instance.hget(version_key, mid)
+    return int(value) if value is not None else 0
+
+
+def get(mid):
+    # The mission, read only and shared with every other caller in this process, or None.
+    current = version(mid)
+    with _missions_lock:
+        cached = _missions.get(mid)
+        if cached is not None and cached[0] == current:
+            return cached[1]
+    mission = load(mid)
+    if mission is None:
+        return None
+    mission = freeze(mission)
+    with _missions_lock:
+        _missions[mid] = (current, mission)
+    return mission
+
+
+def load(mid):
+    # A fresh copy of the mission to change and put() back, or None.
+    data = constants.redis_instance.hget(mission_key, mid)
+    if data is None:
+        return None
+    return decode(data)
+
+
+def put(mid, mission):
+    pipe = constants.redis_instance.pipeline()
+    pipe.hset(mission_key, mid, encode(mission))
+    pipe.hincrby(version_key, mid, 1)
+    pipe.execute()
@@ -0,0 +1,180 @@
+import io
+import json
+import math
+import threading
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+import sdig.util.zc as zc
+import constants
+import db
+import erddap
+import simplify
+
+# The overview map of every mission on the home page. It only changes when the locations do,
+# so the ingest renders it once per generation of the locations table (see db.generation) and
+# stores the figure JSON in redis, once for each of the simplify.tolerances. The page starts
+# with the tolerance for the zoom that fits every mission and switches as the map is zoomed.
+# The web processes only read what the ingest stored, and keep the figures they loaded for
+# the generation stored with them.
+#
+# Below clip_tolerance simplifying keeps nearly every point of the whole catalogue, so for those
+# tolerances the ingest stores the simplified tracks instead of a figure, and the web process
+# draws just the tracks in view (simplify.clip) whenever the map is zoomed or moved.
+
+figure_key = 'overview_map'
+track_columns = ['longitude', 'latitude', 'time', 'mission_id', 'trajectory', 'title']
+clip_tolerance = 0.1
+
+_figures = {}
+_figures_generation = None
+_figures_lock = threading.Lock()
+
+
+def make_overview_map(df, tolerance, zoom, center, group=None):
+    if group is None:
+        group = ['mission_id', 'trajectory']
+    df = df.sort_values('mission_id', kind='stable')
+    tracks = simplify.simplify(df, tolerance, group)
+    overview_map = go.Figure(simplify.track_traces(
+        tracks, group, 'title', ['mission_id', 'title', 'time'], px.colors.qualitative.Dark24
+    ))
+    overview_map.update_traces(selector={'mode': 'markers'},
+                               hovertemplate='<b>%{customdata[1]}</b><br><br>Latitude: %{lat}<br>Longitude: %{lon}<br>Time: %{customdata[2]}<extra></extra>')
+
+    overview_map.update_layout(
+        legend_title='Mission',
+        legend_orientation="v",
+        legend_x=1.,
+        height=1250,
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        map_style="white-bg",
+        map_layers=[
+            {
+                "below": 'traces',
+                "sourcetype": "raster",
+                "sourceattribution": "General Bathymetric Chart of the Oceans (GEBCO); NOAA National Centers for Environmental Information (NCEI)",
+                "source": [
+                    'https://tiles.arcgis.com/tiles/C8EMgrsFcRFL6LrL/arcgis/rest/services/GEBCO_basemap_NCEI/MapServer/tile/{z}/{y}/{x}'
+                ]
+            }
+        ],
+        map_zoom=zoom,
+        map_center=center,
+        # Keep the user's view when the figure is swapped for another tolerance.
+        uirevision='overview',
+    )
+    return overview_map
+
+
+def render(generation=None):
+    # Draw the map from the locations table and store it with the generation it was drawn from.
+    if generation is None:
+        generation = db.generation()
+    df = db.get_locations(columns=['latitude', 'longitude', 'time', 'trajectory', 'title', 'mission_id'])
+    df['time'] = erddap.time_strings(df['time'])
+    zoom, center = zc.zoom_center(df['longitude'], df['latitude'])
+    mapping = {}
+    for tolerance in simplify.tolerances:
+        if tolerance < clip_tolerance:
+            tracks = simplify.simplify(df, tolerance, ['mission_id', 'trajectory'])
+            mapping['tracks:' + str(tolerance)] = tracks[track_columns].to_json(orient='split', index=False)
+        else:
+            mapping['figure:' + str(tolerance)] = pio.to_json(make_overview_map(df, tolerance, zoom, center), validate=False)
+    mapping['generation'] = generation
+    mapping['tolerance'] = str(simplify.tolerance_for_zoom(zoom))
+    mapping['view'] = json.dumps({'zoom': zoom, 'center': center})
+    # Replace the whole hash so figures of another generation never linger.
+    pipe = constants.redis_instance.pipeline()
+    pipe.delete(figure_key)
+    pipe.hset(figure_key, mapping=mapping)
+    pipe.execute()
+    return generation
+
+
+def is_rendered():
+    return constants.redis_instance.hexists(figure_key, 'generation')
+
+
+def view_bounds(relayout_data, width=2000, height=1250):
+    # [west, south, east, north] of the map from its relayoutData, with a screen's worth around
+    # it so small moves don't uncover the edge, or None if it doesn't say where the map is.
+    derived = relayout_data.get('map._derived')
+    if isinstance(derived, dict) and 'coordinates' in derived:
+        lons = [c[0] for c in derived['coordinates']]
+        lats = [c[1] for c in derived['coordinates']]
+        west, south, east, north = min(lons), min(lats), max(lons), max(lats)
+    elif 'map.center' in relayout_data and 'map.zoom' in relayout_data:
+        center = relayout_data['map.center']
+        degrees = 360.0 / (256.0 * 2.0 ** float(relayout_data['map.zoom']))
+        half_lon = width / 2.0 * degrees
+        half_lat = height / 2.0 * degrees * math.cos(math.radians(center['lat']))
+        west, south, east, north = center['lon'] - half_lon, center['lat'] - half_lat, center['lon'] + half_lon, center['lat'] + half_lat
+    else:
+        return None
+    lon_margin = east - west
+    lat_margin = north - south
+    return [west - lon_margin, south - lat_margin, east + lon_margin, north + lat_margin]
+
+
+def is_clipped(tolerance):
+    return tolerance < clip_tolerance
+
+
+def get_tracks(tolerance):
+    # The simplified tracks the ingest stored for a clipped tolerance, kept like the figures.
+    return get_figure_part('tracks:' + str(tolerance),
+                           lambda data: pd.read_json(io.StringIO(data.decode('utf-8')), orient='split', dtype=False, convert_dates=False))
+
+
+def get_figure_part(field, decode):
+    # A field of the stored hash, decoded once per generation in each process.
+    global _figures_generation
+    stored_generation = constants.redis_instance.hget(figure_key, 'generation')
+    if stored_generation is None:
+        return None
+    generation = int(stored_generation)
+    with _figures_lock:
+        if _figures_generation != generation:
+            _figures.clear()
+            _figures_generation = generation
+        if field in _figures:
+            return _figures[field]
+    data = constants.redis_instance.hget(figure_key, field)
+    if data is None:
+        return None
+    value = decode(data)
+    with _figures_lock:
+        if _figures_generation == generation:
+            _figures[field] = value
+    return value
+
+
+def get_clipped_figure(tolerance, bounds):
+    # The overview map at a clipped tolerance with the tracks in bounds (all of them for None).
+    tracks = get_tracks(tolerance)
+    view = get_figure_part('view', json.loads)
+    if tracks is None or view is None:
+        return None
+    clipped = simplify.clip(tracks, bounds, ['mission_id', 'trajectory'])
+    figure = make_overview_map(clipped, 0.0, view['zoom'], view['center'], group=['mission_id', 'trajectory', 'segment'])
+    return figure.to_plotly_json()
+
+
+def get_figure(tolerance=None, bounds=None):
+    # The overview map the ingest stored as a figure dict, at the tolerance or at the one for the
+    # initial zoom, or None when it hasn't stored one yet. The finer tolerances are clipped to bounds.
+    if tolerance is None:
+        tolerance = initial_tolerance()
+    if is_clipped(tolerance):
+        return get_clipped_figure(tolerance, bounds)
+    return get_figure_part('figure:' + str(tolerance), json.loads)
+
+
+def initial_tolerance():
+    # The tolerance of the figure the home page starts with.
+    tolerance = constants.redis_instance.hget(figure_key, 'tolerance')
+    if tolerance is None:
+        return simplify.tolerances[0]
+    return float(tolerance)
@@ -1,59 +1,54 @@
 import dash
-from dash import html, dcc, callback, Input, Output, exceptions
+from dash import html, dcc, callback, Input, Output, State, exceptions
 import dash_design_kit as ddk
-import plotly.express as px
 import plotly.graph_objects as go
 import os
 import json
 import redis
 import pandas as pd
-import db
-import sdig.util.zc as zc
+import overview
+import simplify
 import constants
 
 dash.register_page(__name__, path='/', )
 
 def layout():
 
-    df = db.get_locations()
-
-    zoom, center = zc.zoom_center(df['longitude'], df['latitude'])
-
-    df = df.sort_values('mission_id')
-
-    overview_map = px.scatter_map(
-        df, 
-        lat='latitude', 
-        lon='longitude', 
-        color='title', 
-        hover_data=['title', 'time'], 
-        custom_data=['mission_id'],
-        color_discrete_sequence=px.colors.qualitative.Dark24
-    )
-    overview_map.update_traces(hovertemplate='<b>%{customdata[1]}</b><br><br>Latitude: %{lat}<br>Longitude: %{lon}<br>Time: %{customdata[2]}<extra></extra>')
-
-    overview_map.update_layout(
-        legend_title='Mission',
-        legend_orientation="v",
-        legend_x=1.,
-        height=1250,
-        margin={"r": 0, "t": 0, "l": 0, "b": 0},
-        map_style="white-bg",
-        map_layers=[
-            {
-                "below": 'traces',
-                "sourcetype": "raster",
-                "sourceattribution": "General Bathymetric Chart of the Oceans (GEBCO); NOAA National Centers for Environmental Information (NCEI)",
-                "source": [
-                    'https://tiles.arcgis.com/tiles/C8EMgrsFcRFL6LrL/arcgis/rest/services/GEBCO_basemap_NCEI/MapServer/tile/{z}/{y}/{x}'
-                ]
-            }
-        ],
-        map_zoom=zoom,
-        map_center=center,
-    )
+    # Drawn by the ingest whenever the locations change, see overview.py.
+    overview_map = overview.get_figure()
+    if overview_map is None:
+        overview_map = constants.get_blank('The map of the missions is not ready yet, it is drawn after the next update of the locations.')
 
     layout = ddk.Block(width=1., children=[
+        dcc.Store(id='overview-tolerance'),
         ddk.Graph(id='overview-map', figure=overview_map)
     ])
-    return layout
\ No newline at end of file
+    return layout
+
+
+@callback(
+    [
+        Output('overview-map', 'figure'),
+        Output('overview-tolerance', 'data')
+    ],
+    [
+        Input('overview-map', 'relayoutData')
+    ],
+    [
+        State('overview-tolerance', 'data')
+    ], prevent_initial_call=True
+)
+def set_overview_tolerance(relayout_data, current_tolerance):
+    # Swap in the tracks simplified for the new zoom, when it calls for another tolerance.
+    # The finer tolerances only draw the tracks in view, so they are redrawn as the map moves.
+    if relayout_data is None or 'map.zoom' not in relayout_data:
+        raise exceptions.PreventUpdate
+    tolerance = simplify.tolerance_for_zoom(relayout_data['map.zoom'])
+    if current_tolerance is None:
+        current_tolerance = overview.initial_tolerance()
+    if tolerance == current_tolerance and not overview.is_clipped(tolerance):
+        raise exceptions.PreventUpdate
+    figure = overview.get_figure(tolerance, overview.view_bounds(relayout_data))
+    if figure is None:
+        raise exceptions.PreventUpdate
+    return [figure, tolerance]
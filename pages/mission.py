@@ -1,22 +1,28 @@
 import dash
-from dash import html, dcc, callback, exceptions, Input, Output, State, callback_context
+from dash import html, dcc, callback, clientside_callback, ClientsideFunction, exceptions, Input, Output, State, callback_context
 import dash_design_kit as ddk
 import plotly.graph_objects as go
 import plotly.express as px
-import json
 import constants
 import db
+import store
+import erddap
+import mission_config
+import simplify
+import downsample
+import resample
 import urllib
-from urllib.parse import parse_qs, quote
+from urllib.parse import parse_qs
 from itertools import filterfalse
 import pandas as pd
-from plotly.subplots import make_subplots
+import plot_grid
 import datetime
 import numpy as np
 import sdig.util.zc as zc
 from sdig.erddap.info import Info
 import time
 import dash_bootstrap_components as dbc
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 height_of_row = 345
@@ -27,19 +33,30 @@ line_rgb = 'rgba(.04,.04,.04,.05)'
 plot_bg = 'rgba(1.0, 1.0, 1.0 ,1.0)'
 
 d_format = "%Y-%m-%d"
-mission_start_seconds = None
-mission_end_seconds = None
 
 blank_graph = constants.get_blank('Pick one or more drones<br>Pick a variable')
 blank_map = constants.get_blank('Pick one or more drones<br>Pick a variable')
 
 dash.register_page(__name__, path="/mission", path_template='/mission/<mission_id>')
 
+def mission_time_range(mission_id, mission):
+    # First and last location of the mission as naive UTC datetimes, from the summary the ingest
+    # stores with the mission (see tasks.set_location_summaries), or from the locations table for
+    # a mission stored before there was one.
+    if 'locations' in mission and mission['locations']['rows'] > 0:
+        return (datetime.datetime.strptime(mission['locations']['start_date'], '%Y-%m-%dT%H:%M:%SZ'),
+                datetime.datetime.strptime(mission['locations']['end_date'], '%Y-%m-%dT%H:%M:%SZ'))
+    time_min, time_max = db.get_mission_time_range(mission_id, mission.get('dsg_id', 'trajectory'))
+    return time_min.tz_convert(None).to_pydatetime(), time_max.tz_convert(None).to_pydatetime()
+
+
 def layout(mission_id=None, **params):
     if mission_id is None:
         return html.Div('')
-    mission  = json.loads(constants.redis_instance.hget("mission", mission_id))  # pyright: ignore[reportArgumentType]
-    df = db.get_mission_locations(mission_id, mission['dsg_id'])
+    mission = mission_config.get(mission_id)
+    sd, ed = mission_time_range(mission_id, mission)
+    # Make sure you cover the rest of the last day.
+    ed = ed + datetime.timedelta(hours=36)
     
     mode = 'lines'
     if 'mode' in params:
@@ -77,29 +94,19 @@ def layout(mission_id=None, **params):
     if 'start_date' in params:
         set_start_date = params['start_date']
     else:
-        set_start_date = df.time.min()
-        
-    # Make sure you cover the rest of the last day.
+        set_start_date = sd.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     if 'end_date' in params:
         set_end_date = params['end_date']
     else:
-        set_end_date = df.time.max()
-        sed = datetime.datetime.strptime(set_end_date, '%Y-%m-%dT%H:%M:%SZ')
-        sed = sed + datetime.timedelta(hours=36)
-        set_end_date = sed.strftime(d_format)
-        
-    mission_start_date = df.time.min()
-    sd = datetime.datetime.strptime(mission_start_date, '%Y-%m-%dT%H:%M:%SZ')
-    mission_start_seconds = sd.timestamp()
+        set_end_date = ed.strftime(d_format)
+
+    # The slider is in seconds since 1970 UTC, like the date conversions in the browser.
+    mission_start_seconds = sd.replace(tzinfo=datetime.timezone.utc).timestamp()
     mission_start_date = sd.strftime(d_format)
-    mission_end_date = df.time.max()
-    ed = datetime.datetime.strptime(mission_end_date, '%Y-%m-%dT%H:%M:%SZ')
-    ed = ed + datetime.timedelta(hours=36)
-    mission_end_seconds = ed.timestamp()
+    mission_end_seconds = ed.replace(tzinfo=datetime.timezone.utc).timestamp()
     mission_end_date = ed.strftime(d_format)
 
-
     time_marks = Info.get_time_marks(mission_start_seconds, mission_end_seconds)
 
     if 'columns' in params:
@@ -166,7 +173,6 @@ def layout(mission_id=None, **params):
         logos.append(text)
     if len(logos) > 0:
         logo_card = ddk.Card(children=logos,)
-    df.sort_values(['trajectory', 'time'], inplace=True)
     mission_title = mission['ui']['title']
 
     if mission_id is None:
@@ -256,6 +262,7 @@ def layout(mission_id=None, **params):
                                 )],
                             )
                         ]),
+                        dcc.Store(id='location-tolerance'),
                         dcc.Loading(ddk.Graph(id='trajectory-map'))
                     ])   
                 ])
@@ -330,6 +337,8 @@ def layout(mission_id=None, **params):
                     dcc.Loading(ddk.Graph(id='timeseries-plots', figure=blank_graph))
                 ])
             ]),
+            dcc.Store(id='download-urls'),
+            dcc.Store(id='plots-traces'),
             dbc.Modal(id='download-dialog', children=[
                 dbc.ModalHeader(children=['Download links for the drones show in the timeseries plot:']),
                 dbc.ModalBody(id='download-links', children="some links"),
@@ -348,18 +357,19 @@ def layout(mission_id=None, **params):
     [
         Input('download', 'n_clicks'),
         Input('close', 'n_clicks')
+    ],
+    [
+        State('download-urls', 'data')
     ]
 )
-def open_download_dialog(open_click, close_click):
+def open_download_dialog(open_click, close_click, download_dict):
     if callback_context.triggered_id is None:
         return [False, dash.no_update]
     if "close" in callback_context.triggered_id:
         return [False, dash.no_update]
-    download_s = constants.redis_instance.hget("downloads", "urls")
     thead = html.Thead(html.Tr([html.Th("Saildrone"), html.Th("CSV"), html.Th("HTML"), html.Th("netCDF")]))
     body_rows = []
-    if download_s is not None and len(download_s) > 0 and 'download' in callback_context.triggered_id:
-        download_dict = json.loads(download_s)
+    if download_dict is not None and len(download_dict) > 0 and 'download' in callback_context.triggered_id:
         for drone_down in download_dict:
             csv_url = download_dict[drone_down]
             html_url = csv_url.replace('.csv', '.htmlTable')
@@ -379,125 +389,44 @@ def open_download_dialog(open_click, close_click):
         return [False, dash.no_update]
 
 
-@callback(
-[
-    Output('url', 'search'),
-    Output('url', 'refresh')
-],[
-    Input('drone', 'value'),
-    Input('trace-decimation', 'value'),
-    Input('trace-variable', 'value'),
-    Input('plots-decimation', 'value'),
-    Input('plot-variables', 'value'),
-    Input('start-date', 'value'),
-    Input('end-date', 'value'),
-    Input('plots-columns', 'value'),
-    Input('plots-mode', 'value'),
-    Input('plots-per', 'value'),
-],[
-    State('url', 'search')
-]
+# The query string follows the controls, in the browser (assets/clientside.js).
+clientside_callback(
+    ClientsideFunction(namespace='saildrone', function_name='set_search'),
+    [
+        Output('url', 'search'),
+        Output('url', 'refresh')
+    ],[
+        Input('drone', 'value'),
+        Input('trace-decimation', 'value'),
+        Input('trace-variable', 'value'),
+        Input('plots-decimation', 'value'),
+        Input('plot-variables', 'value'),
+        Input('start-date', 'value'),
+        Input('end-date', 'value'),
+        Input('plots-columns', 'value'),
+        Input('plots-mode', 'value'),
+        Input('plots-per', 'value'),
+    ],[
+        State('url', 'search')
+    ]
 )
-def set_search(drone,
-               trace_decimation,
-               trace_variable,
-               plots_decimation,
-               plot_variables,
-               selected_start_date,
-               selected_end_date,
-               num_plot_cols,
-               plot_mode,
-               plots_per,
-               state_search
-            ):
-    
-    s = ''
-    state_params = {}
-    if state_search is not None:
-        state_params = parse_qs(state_search[1:])
-    
-    if 'mission_id' in state_params:
-        # I don't know how we would get here without this being set
-        mission_id = state_params['mission_id']
-        s = '?mission_id=' + mission_id[0]
-
-
-    if drone is not None:
-        if isinstance(drone, list):
-            for d in drone:
-                s = s + '&drone=' + d
-        elif isinstance(drone, str):
-            # if drone in check_mission_drones:
-            s = s + '&drone=' + drone
-    if trace_decimation is not None:
-        if len(s) == 1:
-            s = s + 'trace_decimation=' + str(trace_decimation)
-        else:
-            s = s + '&trace_decimation=' + str(trace_decimation)
-    if trace_variable is not None:
-        if len(s) == 1:
-            s = s + 'trace_variable=' + trace_variable
-        else:
-            s = s + '&trace_variable=' + trace_variable
-    if plots_decimation is not None:
-        if len(s) == 1:
-            s = s + 'plots_decimation=' + str(plots_decimation)
-        else:
-            s = s + '&plots_decimation=' + str(plots_decimation)
-    if plot_variables is not None:
-        if isinstance(plot_variables, list):
-            for ts in plot_variables:
-                if len(s) == 1:
-                    s = s + 'timeseries=' + ts
-                else:
-                    s = s + '&timeseries=' + ts
-        elif isinstance(plot_variables, str):
-            s = s + '&timeseries=' + plot_variables
-
-    if selected_start_date is not None:
-        if len(selected_start_date) > 0:
-            s = s + '&start_date=' + selected_start_date
-
-    if selected_end_date is not None:
-        if len(selected_end_date) > 0:
-            s = s + '&end_date=' + selected_end_date
-
-    if num_plot_cols is not None:
-        s = s + '&columns=' + str(num_plot_cols)
-
-    if plot_mode is not None:
-        s = s + '&mode=' + plot_mode
-
-    pp_value = 'all'
-    if plots_per is not None:
-        if isinstance(plots_per, list):
-            if len(plots_per) > 0:
-                pp_value = plots_per[0]
-        if len(s) == 1:
-            s = s + 'plots_per=' + str(pp_value)
-        else:
-            s = s + '&plots_per=' + str(pp_value)
-
-    if len(s) == 1:
-        return ['']
-    else:
-        return [s, False]
 
 
 @callback([
-    Output('trace-trigger', 'data'),
     Output('trace-decimation', 'style')
 ], [
-    Input('drone', 'value'),
-    Input('trace-decimation', 'value'),
-    Input('trace-variable', 'value'),
-    Input('start-date', 'value'),
-    Input('end-date', 'value')
-], [
-    State('url', 'search')
-]
-)
-def set_trace_data(drone, trace_decimation, trace_variable, selected_start_date, selected_end_date, state_search):
+    Input('trace-variable', 'value')
+])
+def set_trace_decimation_visibility(trace_variable):
+    if trace_variable == 'location':
+        visibility = constants.HIDDEN
+    else:
+        visibility = constants.VISIBLE
+    return [visibility]
+
+
+def get_trace_config(drone, trace_decimation, trace_variable, selected_start_date, selected_end_date, state_search):
+    # The trajectory map choices, checked against the mission.
 
     # Bail immediately if you don't have drones or you don't have a variable to plot
     if drone is None:
@@ -525,7 +454,7 @@ def set_trace_data(drone, trace_decimation, trace_variable, selected_start_date,
     check_mission_drones = []
 
     if cur_id is not None:
-        cur_mission = json.loads(constants.redis_instance.hget("mission", cur_id))
+        cur_mission = mission_config.get(cur_id)
         check_mission_drones = cur_mission['drones']
     if isinstance(drone, list):
         if len(check_mission_drones) > 0:
@@ -560,23 +489,110 @@ def set_trace_data(drone, trace_decimation, trace_variable, selected_start_date,
                 trace_config['config']['end_date'] = selected_end_date[0]
             else:
                 trace_config['config']['end_date'] = selected_end_date
-    constants.redis_instance.hset("saildrone", "trace_config", json.dumps(trace_config))
+    return trace_config
+
+
+def make_location_map(cur_mission_id, the_cur_mission, pdrones, start_date, end_date, tolerance=None):
+    # The daily locations of the drones as tracks simplified to a tolerance (simplify.py), by
+    # default the one for a map fit to the tracks. Returns the figure and the tolerance.
+    dsg_id = the_cur_mission['dsg_id']
+    df = db.get_mission_locations(cur_mission_id, dsg_id, start_date=start_date, end_date=end_date, drones=pdrones,
+                                  columns=['latitude', 'longitude', 'time', dsg_id])
+    if tolerance is None:
+        tolerance = simplify.tolerance_for_extent(df)
+    df['time'] = erddap.time_strings(df['time'])
+    tracks = simplify.simplify(df, tolerance, [dsg_id])
+    drone_map = go.Figure(simplify.track_traces(tracks, [dsg_id], dsg_id, [dsg_id, 'time'], px.colors.qualitative.Dark24, kind='geo'))
+    drone_map.update_traces(selector={'mode': 'markers'},
+                            hovertemplate='trajectory=%{customdata[0]}<br>latitude=%{lat}<br>longitude=%{lon}<br>time=%{customdata[1]}<extra></extra>')
+    drone_map.update_geos(
+        fitbounds='locations',
+        resolution=50,
+        showcoastlines=True, coastlinecolor="Black",
+        showland=True, landcolor="Tan",
+        showocean=True, oceancolor="LightBlue",
+    )
+    drone_map.update_layout(
+        title='Daily locations of each mission drone.',
+        margin={"r":0,"t":60,"l":0,"b":0}, 
+        legend_title_text='Drone',
+        legend_orientation='v',
+        legend_x=constants.legend_location,
+        # Keep the user's view when the tracks are swapped for another tolerance.
+        uirevision='locations',
+        meta={'tolerance': tolerance},
+    )
+    return drone_map, tolerance
 
-    if trace_variable == 'location':
-        visibility = constants.HIDDEN
-    else:
-        visibility = constants.VISIBLE
-    return ['go', visibility]
+
+@callback(
+    [
+        Output('trajectory-map', 'figure', allow_duplicate=True),
+        Output('location-tolerance', 'data')
+    ],
+    [
+        Input('trajectory-map', 'relayoutData'),
+        Input('trace-trigger', 'data')
+    ],
+    [
+        State('location-tolerance', 'data'),
+        State('url', 'search')
+    ], prevent_initial_call=True
+)
+def set_location_tolerance(relayout_data, trace_config, current_tolerance, state_search):
+    # Redraw the daily locations with the tolerance for the new zoom of the map when it changes.
+    if callback_context.triggered_id == 'trace-trigger':
+        # A new map was drawn, it starts out at the tolerance that fits it.
+        return [dash.no_update, None]
+    if relayout_data is None or 'geo.projection.scale' not in relayout_data:
+        raise exceptions.PreventUpdate
+    state_params = {}
+    if state_search is not None:
+        state_params = parse_qs(state_search[1:])
+    if 'mission_id' not in state_params:
+        raise exceptions.PreventUpdate
+    cur_mission_id = state_params['mission_id'][0]
+    if trace_config is None:
+        raise exceptions.PreventUpdate
+    config = trace_config['config']
+    if 'location' not in config.get('trace_variable', []) or 'drones' not in config:
+        raise exceptions.PreventUpdate
+    the_cur_mission = mission_config.get(cur_mission_id)
+    dsg_id = the_cur_mission['dsg_id']
+    df = db.get_mission_locations(cur_mission_id, dsg_id, start_date=config.get('start_date'), end_date=config.get('end_date'),
+                                  drones=config['drones'], columns=['latitude', 'longitude'])
+    # The map is fit to the tracks, so take scale 1 as their extent across about 1000 pixels.
+    if current_tolerance is None:
+        current_tolerance = simplify.tolerance_for_extent(df)
+    span = max(np.ptp(df['longitude'].to_numpy(dtype=float)), np.ptp(df['latitude'].to_numpy(dtype=float)), 1e-6) if df.shape[0] > 0 else 360.0
+    tolerance = simplify.tolerance_for_degrees_per_pixel(span / (1000 * float(relayout_data['geo.projection.scale'])))
+    if tolerance == current_tolerance:
+        raise exceptions.PreventUpdate
+    drone_map, tolerance = make_location_map(cur_mission_id, the_cur_mission, config['drones'], config.get('start_date'),
+                                             config.get('end_date'), tolerance)
+    return [drone_map, tolerance]
 
 
 @callback([
     Output('trajectory-map', 'figure'),
+    Output('trace-trigger', 'data'),
 ], [
-    Input('trace-trigger', 'data'),
+    Input('drone', 'value'),
+    Input('trace-decimation', 'value'),
+    Input('trace-variable', 'value'),
+    Input('start-date', 'value'),
+    Input('end-date', 'value')
 ], [
     State('url', 'search')
-], prevent_initial_call=True, background=True)
-def make_trajectory_trace(trace_config, state_search):
+], background=True)
+def make_trajectory_trace(drone, trace_decimation, trace_variable, selected_start_date, selected_end_date, state_search):
+    # The choices go straight to the drawing. The map's configuration is left in trace-trigger
+    # for the callbacks that redraw it.
+    trace_config = get_trace_config(drone, trace_decimation, trace_variable, selected_start_date, selected_end_date, state_search)
+    return draw_trajectory(trace_config, state_search) + [trace_config]
+
+
+def draw_trajectory(trace_config, state_search):
     if trace_config is None:
         raise dash.exceptions.PreventUpdate
     elif len(trace_config) == 0:
@@ -598,13 +614,13 @@ def make_trajectory_trace(trace_config, state_search):
     elif len(cur_mission_id) == 0:
         raise dash.exceptions.PreventUpdate
 
-    the_cur_mission = json.loads(constants.redis_instance.hget("mission", cur_mission_id))
+    the_cur_mission = mission_config.get(cur_mission_id)
 
     trace_decimation = 24
     trace_start_date = None
     trace_end_date = None
 
-    trace_json = json.loads(constants.redis_instance.hget("saildrone", "trace_config"))
+    trace_json = trace_config
     if 'drones' in trace_json['config']:
         pdrones = trace_json['config']['drones']
     else:
@@ -626,34 +642,8 @@ def make_trajectory_trace(trace_config, state_search):
         trace_end_date = trace_json['config']['end_date']
 
     if 'location' in trace_variable:
-        df = db.get_mission_locations(cur_mission_id, the_cur_mission['dsg_id'])
-        # Trim the locations by time and selected drones
-        df = df.loc[df['time']>=trace_start_date]
-        df = df.loc[df['time']<=trace_end_date]
-        df = df.loc[df[the_cur_mission['dsg_id']].isin(pdrones)]
         # this is a special plot of only the locations of the drones
-        drone_map = px.scatter_geo(
-            df, 
-            lat='latitude', 
-            lon='longitude', 
-            color='trajectory', 
-            fitbounds='locations', 
-            hover_data=['time'], 
-            color_discrete_sequence=px.colors.qualitative.Dark24,
-            title='Daily locations of each mission drone.'
-        )
-        drone_map.update_geos(
-            resolution=50,
-            showcoastlines=True, coastlinecolor="Black",
-            showland=True, landcolor="Tan",
-            showocean=True, oceancolor="LightBlue",
-        )
-        drone_map.update_layout(
-            margin={"r":0,"t":60,"l":0,"b":0}, 
-            legend_title_text='Drone',
-            legend_orientation='v',
-            legend_x=constants.legend_location,
-        )
+        drone_map, tolerance = make_location_map(cur_mission_id, the_cur_mission, pdrones, trace_start_date, trace_end_date)
         return [drone_map]
 
 
@@ -683,19 +673,31 @@ def make_trajectory_trace(trace_config, state_search):
         if '00:00:00' in trace_end_date:
             trace_end_date = trace_end_date.replace('00:00:00', "23:59:59")
         order_by = order_by + '&time<=' + trace_end_date
-    data_tables = []
-    for drone_id in pdrones:
-        base_url = cur_drones[drone_id]['url'] + '.csv?'
+    def read_trace_drone(drone_id):
+        # From the store if it has the drone, from ERDDAP if it doesn't or can't be read.
+        try:
+            d_df = store.read_drone(cur_mission_id, drone_id, trace_variable, trace_start_date, trace_end_date, trace_decimation)
+        except Exception as ex:
+            print('Trajectory plot: exception reading ' + drone_id + ' from the store, reading from ERDDAP.')
+            print('e=' + str(ex))
+            d_df = None
+        if d_df is not None:
+            d_df['time'] = erddap.time_strings(d_df['time'])
+            return d_df
         traj_query = '&trajectory="' + drone_id + '"' + order_by
-        encoded_query = quote(traj_query, safe='&()=:/')
-        tr_drone_url = base_url + req_var + encoded_query
+        d_url = cur_drones[drone_id]['url']
         try:
-            d_df = pd.read_csv(tr_drone_url, skiprows=[1])
-            data_tables.append(d_df)
+            d_df = erddap.read_table(d_url, trace_variable, traj_query, erddap.get_metadata(d_url)['var_types'])
+            d_df['time'] = erddap.time_strings(d_df['time'])
+            return d_df
         except Exception as ex:
-            print('Trajectory plot: exception getting data from url: ' + tr_drone_url)
+            print('Trajectory plot: exception getting ' + req_var + ' from ' + d_url + ' with ' + traj_query)
             print('e=' + str(ex))
-            continue
+            return None
+
+    # Read the drones at the same time, map() keeps them in the order they were picked.
+    with ThreadPoolExecutor(max_workers=max(1, min(constants.plot_fetch_workers, len(pdrones)))) as pool:
+        data_tables = [d_df for d_df in pool.map(read_trace_drone, pdrones) if d_df is not None]
 
     if len(data_tables) == 0:
         return [constants.get_blank('No data for this combination of selections.')]
@@ -725,9 +727,12 @@ def make_trajectory_trace(trace_config, state_search):
                               tickvals=[df['millis'].iloc[0], df['millis'].iloc[-1]])
     zoom, center = zc.zoom_center(lons=df['longitude'], lats=df['latitude'])
     annotation = None
-    if df.shape[0] > 25000:
-        df = df.sample(n=25000).sort_values(by=['time', 'trajectory'], ascending=True)
-        annotation = 'Sub-sampled to 25,000 points.'
+    if df.shape[0] > constants.map_points:
+        # Split the points between the drones and keep the extremes of the variable along each track.
+        per_drone = constants.map_points // df['trajectory'].nunique()
+        df = pd.concat([downsample.downsample(d_df, 'millis', plot_var, per_drone) for drone_id, d_df in df.groupby('trajectory', sort=False)])
+        df = df.sort_values(by=['time', 'trajectory'], ascending=True)
+        annotation = 'Down-sampled to ' + f'{constants.map_points:,}' + ' points.'
     location_trace = go.Figure(go.Scattermap(lat=df["latitude"], lon=df["longitude"],
                                       text=df['text'],
                                       marker=dict(showscale=True, color=df[plot_var],
@@ -768,22 +773,8 @@ def make_trajectory_trace(trace_config, state_search):
     return [location_trace]
 
 
-@callback([
-    Output('plots-trigger', 'data'),
-], [
-    Input('drone', 'value'),
-    Input('plots-decimation', 'value'),
-    Input('plot-variables', 'value'),
-    Input('start-date', 'value'),
-    Input('end-date', 'value'),
-    Input('plots-columns', 'value'),
-    Input('plots-mode', 'value'),
-    Input('plots-per', 'value'),
-], [
-    State('url', 'search')
-]
-)
-def set_plots_data(drone, plots_decimation, plot_variables, selected_start_date, selected_end_date, columns, mode, plots_per, state_search):
+def get_plots_config(drone, plots_decimation, plot_variables, selected_start_date, selected_end_date, columns, mode, plots_per, state_search):
+    # The time series choices, checked against the mission.
 
     if drone is None:
         raise exceptions.PreventUpdate
@@ -815,7 +806,7 @@ def set_plots_data(drone, plots_decimation, plot_variables, selected_start_date,
     check_mission_drones = []
 
     if cur_id is not None:
-        cur_mission = json.loads(constants.redis_instance.hget("mission", cur_id))
+        cur_mission = mission_config.get(cur_id)
         check_mission_drones = cur_mission['drones']
     if isinstance(drone, list):
         if len(check_mission_drones) > 0:
@@ -861,14 +852,22 @@ def set_plots_data(drone, plots_decimation, plot_variables, selected_start_date,
         if len(selected_end_date) > 0:
             plots_config['config']['end_date'] = selected_end_date
 
-    constants.redis_instance.hset("saildrone", "plots_config", json.dumps(plots_config))
-    return ['go']
+    return plots_config
 
 
 @callback(
     Output('timeseries-plots', 'figure'),
     Output('download', 'disabled'),
-    Input('plots-trigger', 'data'),
+    Output('download-urls', 'data'),
+    Output('plots-traces', 'data'),
+    Input('drone', 'value'),
+    Input('plots-decimation', 'value'),
+    Input('plot-variables', 'value'),
+    Input('start-date', 'value'),
+    Input('end-date', 'value'),
+    Input('plots-columns', 'value'),
+    Input('plots-mode', 'value'),
+    Input('plots-per', 'value'),
     State('url', 'search'),
     background=True,
     running=[
@@ -879,9 +878,14 @@ def set_plots_data(drone, plots_decimation, plot_variables, selected_start_date,
         ),
     ],
     progress=[Output("progress-bar", "value"), Output("progress-bar", "max")],
-    prevent_initial_call=True,    
 )
-def make_plots(set_progress, trigger, state_search):
+def make_plots(set_progress, drone, plots_decimation, plot_variables, selected_start_date, selected_end_date, columns, mode, plots_per, state_search):
+    # The choices go straight to the drawing.
+    plots_config = get_plots_config(drone, plots_decimation, plot_variables, selected_start_date, selected_end_date, columns, mode, plots_per, state_search)
+    return draw_plots(set_progress, plots_config, state_search)
+
+
+def draw_plots(set_progress, plots_config, state_search):
     # TIMING
     # start = time.perf_counter()
     set_progress(("0","0"))
@@ -899,21 +903,22 @@ def make_plots(set_progress, trigger, state_search):
     plots_start_date = None
     plots_end_date = None
 
-    plots_config = json.loads(constants.redis_instance.hget("saildrone", "plots_config"))
-    # DEBUG print('plots config loaded')
+    if plots_config is None:
+        raise dash.exceptions.PreventUpdate
     # must have a drone, and a variable
     if 'drones' in plots_config['config']:
-        tsdrones = plots_config['config']['drones']
+        # A drone can be in the query string more than once, plot it once.
+        tsdrones = list(dict.fromkeys(plots_config['config']['drones']))
     else:
-        return [blank_graph, True]
+        return [blank_graph, True, dash.no_update, None]
 
     if 'timeseries' in plots_config['config']:
         plot_variables = plots_config['config']['timeseries']
         original_order = plot_variables.copy()
         if len(plot_variables) == 0:
-            return [blank_graph, True]
+            return [blank_graph, True, dash.no_update, None]
     else:
-        return [blank_graph, True]
+        return [blank_graph, True, dash.no_update, None]
     max_progress = (len(tsdrones)*len(plot_variables)) + 2
     progress = 1
     set_progress((str(progress), str(max_progress)))
@@ -932,7 +937,7 @@ def make_plots(set_progress, trigger, state_search):
     if 'plots_per' in plots_config['config']:
         plots_per = plots_config['config']['plots_per']
 
-    the_mission_config = json.loads(constants.redis_instance.hget("mission", cur_mission_id))
+    the_mission_config = mission_config.get(cur_mission_id)
     # DEBUG print('mission config loaded')
     cur_drones = the_mission_config['drones']
     # the next thing
@@ -966,46 +971,61 @@ def make_plots(set_progress, trigger, state_search):
     # setup_over = time.perf_counter()
     # setup_time = setup_over - start
     download_urls = {}
-    plot_data_tables = []
-    for d_ts in tsdrones:
+
+    def read_plots_drone(d_ts):
         drone_plot_variables = plot_variables.copy()
         for plot_var in plot_variables:
             if plot_var not in cur_drones[d_ts]['variables']:
                 drone_plot_variables.remove(plot_var)
                 
         req_var = ",".join(drone_plot_variables)
-        url_base = cur_drones[d_ts]['url'] + '.csv?'
         query = '&trajectory="' + d_ts + '"' + order_by
-        q = urllib.parse.quote(query, safe='&()=:/')
-        full_query = '&trajectory="' + d_ts + '"'
-        fq = urllib.parse.quote(full_query, safe='&()=:/')
-        drone_url = url_base + req_var + q
-        download_urls[d_ts] = url_base + req_var + fq + download_time_con_start + download_time_con_end
+        d_url = cur_drones[d_ts]['url']
+        # From the store if it has the drone, from ERDDAP if it doesn't or can't be read.
+        try:
+            ts_df = store.read_drone(cur_mission_id, d_ts, drone_plot_variables, plots_start_date, plots_end_date, plots_decimation)
+        except Exception as e:
+            print('Timeseries plots: exception reading ' + d_ts + ' from the store, reading from ERDDAP.')
+            print('e=', str(e))
+            ts_df = None
+        if ts_df is not None:
+            return ts_df
         try:
             # DEBUG 
-            print('reading drone data from ' + drone_url)
-            ts_df = pd.read_csv(drone_url, skiprows=[1], parse_dates=['time'])
-            plot_data_tables.append(ts_df)
-            progress = progress + 1
-            set_progress((str(progress), str(max_progress)))
+            print('reading drone data ' + req_var + ' from ' + d_url + ' with ' + query)
+            return erddap.read_table(d_url, drone_plot_variables, query, erddap.get_metadata(d_url)['var_types'])
         except Exception as e:
-            print('Timeseries plots: exception getting data from ' + drone_url)
+            print('Timeseries plots: exception getting ' + req_var + ' from ' + d_url + ' with ' + query)
             print('e=', str(e))
-            continue
-    constants.redis_instance.hset("downloads", "urls", json.dumps(download_urls))
+            return None
+
+    for d_ts in tsdrones:
+        drone_plot_variables = [plot_var for plot_var in plot_variables if plot_var in cur_drones[d_ts]['variables']]
+        url_base = cur_drones[d_ts]['url'] + '.csv?'
+        full_query = '&trajectory="' + d_ts + '"'
+        fq = urllib.parse.quote(full_query, safe='&()=:/')
+        download_urls[d_ts] = url_base + ",".join(drone_plot_variables) + fq + download_time_con_start + download_time_con_end
+
+    # Read the drones at the same time and move the progress bar as each one arrives. The
+    # tables are put back in the order the drones were picked.
+    drone_tables = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(constants.plot_fetch_workers, len(tsdrones)))) as pool:
+        futures = {pool.submit(read_plots_drone, d_ts): d_ts for d_ts in tsdrones}
+        for future in as_completed(futures):
+            drone_tables[futures[future]] = future.result()
+            if drone_tables[futures[future]] is not None:
+                progress = progress + 1
+                set_progress((str(progress), str(max_progress)))
+    plot_data_tables = [drone_tables[d_ts] for d_ts in tsdrones if drone_tables[d_ts] is not None]
     if len(plot_data_tables) == 0:
-        return [constants.get_blank('No data for this combination of selections.'), True]
+        return [constants.get_blank('No data for this combination of selections.'), True, download_urls, None]
     df = pd.concat(plot_data_tables)
     if df.shape[0] < 3:
-        return [constants.get_blank('No data for this combination of selections.'), True]
+        return [constants.get_blank('No data for this combination of selections.'), True, download_urls, None]
     df['trajectory'] = df['trajectory'].astype(str)
     colnames = list(df.columns)
-    df.loc[:, 'text_time'] = df['time'].astype(str)
     annotation = None
     sub_title = ''
-    if df.shape[0] > 25000:
-        annotation = 'All timeseries plots sub-sampled to 25,000 total points each.'
-        df = df.sample(n=25000).sort_values(by=['time', 'trajectory'], ascending=True)
     subplots = {}
     titles = {}
     # DEBUG print('finished subsample')
@@ -1037,57 +1057,55 @@ def make_plots(set_progress, trigger, state_search):
         mode = plots_config['config']['mode']
     if mode == 'both':
         mode = 'lines+markers'
-    legend_count = 0
-    for var in original_order:
-        if var in df.columns.to_list():
-            dfvar = df[['time', 'text_time', 'trajectory', var]].copy()
-            # dfvar.loc[:, 'text_time'] = dfvar['time'].astype(str)
-            dfvar.loc[:, 'time'] = pd.to_datetime(dfvar['time'])
-            dfvar.dropna(subset=[var], how='all', inplace=True)
-            if dfvar.shape[0] > 2:
-                subtraces = []
-                for drn in tsdrones:
-                    index = sorted(list(cur_drones.keys())).index(drn)
-                    n_color = px.colors.qualitative.Dark24[index % 24]
-                    dfvar_drone = dfvar.loc[(dfvar['trajectory'] == drn)]
-                    if plots_decimation > 0 and dfvar_drone.shape[0] > 3:
-                        df2 = dfvar_drone.set_index('time')
-                        # make a index at the expected delta
-                        fill_dates = pd.date_range(dfvar_drone['time'].iloc[0], dfvar_drone['time'].iloc[-1], freq=fre)
-                        all_dates = fill_dates.append(df2.index)
-                        fill_sort = sorted(all_dates)
-                        pdf3 = df2.reindex(fill_sort)
-                        mask1 = ~pdf3['trajectory'].notna() & ~pdf3['trajectory'].shift().notna()
-                        mask2 = pdf3['trajectory'].notna()
-                        pdf4 = pdf3[mask1 | mask2]
-                        dfvar_drone = pdf4.reset_index()
-                    dfvar_drone = dfvar_drone.sort_values(by=['time', 'trajectory'], ascending=True)
-                    show_legend=True
-                    if legend_count > 0:
-                        show_legend=False
-                    varplot = go.Scattergl(x=dfvar_drone['time'], y=dfvar_drone[var], name=drn,
-                                        marker={'color': n_color},
-                                        mode=mode, hoverinfo='x+y+name', showlegend=show_legend, legendgroup=drn)
-                    progress = progress + 1
-                    set_progress((str(progress), str(max_progress)))
-                    subtraces.append(varplot)
-                    # DEBUG print('plotting ' + str(drn))
-                legend_count = legend_count+1
-                subplots[var] = subtraces
-                title = var + sub_title
-                if var in cur_long_names:
-                    title = cur_long_names[var] + sub_title
-
-                if var in cur_units:
-                    title = title + ' (' + cur_units[var] + ')'
-                titles[var] = title
+    # Put the table in shape once: times typed, the drones as a categorical in the order they
+    # were picked and their colors looked up, so the traces come out of a single pass over the drones.
+    df['time'] = pd.to_datetime(df['time'])
+    df['trajectory'] = pd.Categorical(df['trajectory'], categories=tsdrones)
+    drone_order = sorted(cur_drones.keys())
+    colors = {drn: px.colors.qualitative.Dark24[drone_order.index(drn) % 24] for drn in tsdrones}
+    # The variables with something to plot, each with a subplot and its traces in the order of the drones.
+    counts = df.notna().sum()
+    plotted = [var for var in original_order if var in df.columns and counts[var] > 2]
+    for var in plotted:
+        subplots[var] = []
+        title = var + sub_title
+        if var in cur_long_names:
+            title = cur_long_names[var] + sub_title
+        if var in cur_units:
+            title = title + ' (' + cur_units[var] + ')'
+        titles[var] = title
+    # Each subplot gets constants.subplot_points, shared by its drones.
+    trace_points = constants.subplot_points
+    if plots_per == 'all':
+        trace_points = constants.subplot_points // len(tsdrones)
+    df = df.sort_values(['trajectory', 'time'], kind='stable')
+    for drn, drone_df in df.groupby('trajectory', observed=False, sort=True):
+        # The gaps are where a variable stops for longer than the decimation. They are found for
+        # all of the drone's variables at once, and a row of NaN goes in front of each.
+        gaps = {}
+        if plots_decimation > 0 and drone_df.shape[0] > 3:
+            gaps = downsample.gap_ends(drone_df, 'time', plotted, fre)
+        for var in plotted:
+            dfvar_drone = drone_df.loc[drone_df[var].notna(), ['time', var]]
+            if dfvar_drone.shape[0] > trace_points:
+                dfvar_drone = downsample.downsample(dfvar_drone, 'time', var, trace_points)
+                annotation = 'Timeseries plots down-sampled to ' + f'{constants.subplot_points:,}' + ' points per plot.'
+            if var in gaps:
+                dfvar_drone = downsample.insert_gaps(dfvar_drone, 'time', gaps[var])
+            # One legend entry per drone, from the traces of the first subplot.
+            varplot = {'type': 'scattergl', 'x': dfvar_drone['time'], 'y': dfvar_drone[var], 'name': drn,
+                       'marker': {'color': colors[drn]},
+                       'mode': mode, 'hoverinfo': 'x+y+name', 'showlegend': (var == plotted[0]), 'legendgroup': drn}
+            progress = progress + 1
+            set_progress((str(progress), str(max_progress)))
+            subplots[var].append(varplot)
 
     if plots_per == 'all':
         num_plots = len(subplots)
     else:
         num_plots = len(subplots) * len(tsdrones)
     if num_plots == 0:
-        return [constants.get_blank('No data for this combination of selections.'), True]
+        return [constants.get_blank('No data for this combination of selections.'), True, download_urls, None]
     num_rows = int(num_plots / num_columns)
     if num_rows == 0:
         num_rows = num_rows + 1
@@ -1114,46 +1132,37 @@ def make_plots(set_progress, trigger, state_search):
                 next_title = titles[plot]
                 titles_list.append(next_title)
 
-    plots = make_subplots(rows=num_rows, cols=num_cols, shared_xaxes='all', subplot_titles=titles_list,
-                          shared_yaxes=False,
-                          row_heights=row_h)
-    plot_index = 1
-    col = 1
-    row = 1
+    # Where the data of each trace comes from, for resample_plots.
+    plots_traces = {
+        'mission_id': cur_mission_id,
+        'start_date': plots_start_date,
+        'end_date': plots_end_date,
+        'decimation': plots_decimation,
+        'freq': fre if plots_decimation > 0 else None,
+        'points': trace_points,
+        'traces': [],
+    }
+    # The traces of each subplot, in the order the subplots fill the grid.
+    cells = []
     for plot in original_order:
         if plot in subplots:
             current_plots = subplots[plot]
             for cp in current_plots:
-                plots.add_trace(cp, row=row, col=col)
-                
+                plots_traces['traces'].append({'drone': cp['name'], 'variable': plot})
                 if plots_per == 'one':
-                    plot_index = plot_index + 1
-                    if plot_index > 1:
-                        if col == num_columns:
-                            row = row + 1
-                    col = plot_index % num_columns
-                    if col == 0:
-                        col = num_columns
-            legend_count = legend_count + 1
+                    cells.append([cp])
             if plots_per == 'all':
-                plot_index = plot_index + 1
-                if plot_index > 1:
-                    if col == num_columns:
-                        row = row + 1
-                col = plot_index % num_columns
-                if col == 0:
-                    col = num_columns
-            # DEBUG print('adding subplot')
-            plots.update_xaxes({'showticklabels': True, 'gridcolor': line_rgb})
-            plots.update_yaxes({'gridcolor': line_rgb})
-            # Position the one and only legend that controls all the plots
-            plots.layout['legend']={'yref': 'paper', 'y': 1.3, 'xref': 'paper', 'x': .1, 'orientation': 'h'}
-
+                cells.append(current_plots)
+    plots = plot_grid.grid_figure(cells, num_rows, num_cols, titles=titles_list, row_heights=row_h,
+                                 xaxis={'showticklabels': True, 'gridcolor': line_rgb},
+                                 yaxis={'gridcolor': line_rgb})
+    # Position the one and only legend that controls all the plots
+    plots['layout']['legend'] = {'yref': 'paper', 'y': 1.3, 'xref': 'paper', 'x': .1, 'orientation': 'h'}
     plots['layout'].update(height=graph_height, margin=dict(l=80, r=80, b=80, t=80, ))
     if annotation is not None:
-        plots.add_annotation(text=annotation,
-                    xref="paper", yref="paper",
-                    x=0.01, y=1.3, showarrow=False)  
+        plots['layout']['annotations'].append({'text': annotation,
+                                               'xref': "paper", 'yref': "paper",
+                                               'x': 0.01, 'y': 1.3, 'showarrow': False})
 
     progress = progress + 1
     set_progress((str(progress), str(max_progress)))
@@ -1172,11 +1181,26 @@ def make_plots(set_progress, trigger, state_search):
 
     print('At ' + str(ct) + ' plotting timeseries of ' + str(colnames) + ' for ' + str(tsdrones) + ' from ' + the_mission_config['ui']['title'])
     set_progress(("0", "0"))
-    return [plots, False]
+    return [plots, False, download_urls, plots_traces]
 
 
 
 @callback(
+    Output('timeseries-plots', 'figure', allow_duplicate=True),
+    Input('timeseries-plots', 'relayoutData'),
+    State('plots-traces', 'data'),
+    prevent_initial_call=True
+)
+def resample_plots(relayout_data, plots_traces):
+    # Fill the zoomed time range with the full resolution data (see resample.py).
+    if relayout_data is None or plots_traces is None:
+        raise exceptions.PreventUpdate
+    return resample.patch(plots_traces, resample.x_range(relayout_data))
+
+
+# The slider and the date inputs follow each other in the browser as well, kept inside the slider's range (assets/clientside.js).
+clientside_callback(
+    ClientsideFunction(namespace='saildrone', function_name='set_date_range_from_slider'),
     [
         Output('time-range-slider', 'value', allow_duplicate=True),
         Output('start-date', 'value'),
@@ -1186,69 +1210,9 @@ def make_plots(set_progress, trigger, state_search):
         Input('time-range-slider', 'value'),
         Input('start-date', 'value'),
         Input('end-date', 'value'),
+    ],
+    [
+        State('time-range-slider', 'min'),
+        State('time-range-slider', 'max'),
     ], prevent_initial_call=True
 )
-def set_date_range_from_slider(slide_values, in_start_date, in_end_date,):
-    if slide_values is None:
-        raise exceptions.PreventUpdate
-
-    range_min = mission_start_seconds
-    range_max = mission_end_seconds
-
-    ctx = callback_context
-    trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
-
-    start_seconds = slide_values[0]
-    end_seconds = slide_values[1]
-
-    start_output = in_start_date
-    end_output = in_end_date
-
-    if trigger_id == 'start-date':
-        try:
-            in_start_date_obj = datetime.datetime.strptime(in_start_date, d_format)
-        except:
-            in_start_date_obj = datetime.datetime.fromtimestamp(start_seconds)
-        start_output = in_start_date_obj.date().strftime(d_format)
-        start_seconds = in_start_date_obj.timestamp()
-        if start_seconds < range_min:
-            start_seconds = range_min
-            in_start_date_obj = datetime.datetime.fromtimestamp(start_seconds)
-            start_output = in_start_date_obj.date().strftime(d_format)
-        elif start_seconds > range_max:
-            start_seconds = range_max
-            in_start_date_obj = datetime.datetime.fromtimestamp(start_seconds)
-            start_output = in_start_date_obj.date().strftime(d_format)
-        elif start_seconds > end_seconds:
-            start_seconds = end_seconds
-            in_start_date_obj = datetime.datetime.fromtimestamp(start_seconds)
-            start_output = in_start_date_obj.date().strftime(d_format)
-    elif trigger_id == 'end-date':
-        try:
-            in_end_date_obj = datetime.datetime.strptime(in_end_date, d_format)
-        except:
-            in_end_date_obj = datetime.datetime.fromtimestamp((end_seconds))
-        end_output = in_end_date_obj.date().strftime(d_format)
-        end_seconds = in_end_date_obj.timestamp()
-        if end_seconds < range_min:
-            end_seconds = range_min
-            in_end_date_obj = datetime.datetime.fromtimestamp(end_seconds)
-            end_output = in_end_date_obj.date().strftime(d_format)
-        elif end_seconds > range_max:
-            end_seconds = range_max
-            in_end_date_obj = datetime.datetime.fromtimestamp(end_seconds)
-            end_output = in_end_date_obj.date().strftime(d_format)
-        elif end_seconds < start_seconds:
-            end_seconds = start_seconds
-            in_end_date_obj = datetime.datetime.fromtimestamp(end_seconds)
-            end_output = in_end_date_obj.date().strftime(d_format)
-    elif trigger_id == 'time-range-slider':
-        in_start_date_obj = datetime.datetime.fromtimestamp(slide_values[0])
-        start_output = in_start_date_obj.strftime(d_format)
-        in_end_date_obj = datetime.datetime.fromtimestamp(slide_values[1])
-        end_output = in_end_date_obj.strftime(d_format)
-
-    return [[start_seconds, end_seconds],
-            start_output,
-            end_output
-            ]
\ No newline at end of file
@@ -0,0 +1,64 @@
+import plotly.io as pio
+
+# The grid of time series plots of the mission page, written straight into a figure dict.
+# make_subplots plus add_trace and update_xaxes for every plot validates the whole layout
+# through plotly's object model each time, which grows with the square of the number of plots.
+# This lays out the same grid as make_subplots(shared_xaxes='all'): the cells in row major
+# order from the top left, an x and y axis anchored to each other for every cell, every x axis
+# matching the one of the bottom left cell and a title annotation over each cell.
+
+_template = None
+
+
+def template():
+    # The default plotly template as a dict, the one a go.Figure would carry.
+    global _template
+    if _template is None:
+        _template = pio.templates[pio.templates.default].to_plotly_json()
+    return _template
+
+
+def axis_name(letter, index):
+    # x, x2, x3 ... as trace references and xaxis, xaxis2, xaxis3 ... as layout keys.
+    return letter + ('' if index == 1 else str(index))
+
+
+def domains(count, spacing, sizes=None):
+    # The [start, end] of each of count cells spread over [0, 1] with spacing between them.
+    if sizes is None:
+        sizes = [1.0] * count
+    total = float(sum(sizes))
+    lengths = [(1.0 - spacing * (count - 1)) * size / total for size in sizes]
+    starts = [sum(lengths[:i]) + spacing * i for i in range(count)]
+    return [[start, start + length] for start, length in zip(starts, lengths)]
+
+
+def grid_figure(cells, rows, cols, titles=None, row_heights=None, xaxis=None, yaxis=None):
+    # A figure dict with the traces of cells[k], a list of trace dicts, in the k-th cell of a
+    # rows x cols grid. titles go over the cells in the same order, xaxis and yaxis are
+    # properties for every axis. Spacing is the make_subplots default, which leaves room for titles.
+    x_domains = domains(cols, 0.2 / cols)
+    vertical_spacing = (0.3 if titles is None else 0.5) / rows
+    # Rows go from the top down, the domains from the bottom up.
+    y_domains = domains(rows, vertical_spacing, None if row_heights is None else row_heights[::-1])[::-1]
+    bottom_left = (rows - 1) * cols + 1
+    layout = {'template': template(), 'annotations': []}
+    data = []
+    for k in range(rows * cols):
+        row, col = divmod(k, cols)
+        index = k + 1
+        x = dict(xaxis or {}, anchor=axis_name('y', index), domain=x_domains[col])
+        if index != bottom_left:
+            x['matches'] = axis_name('x', bottom_left)
+        layout[axis_name('xaxis', index)] = x
+        layout[axis_name('yaxis', index)] = dict(yaxis or {}, anchor=axis_name('x', index), domain=y_domains[row])
+        if titles is not None and k < len(titles):
+            layout['annotations'].append({
+                'text': titles[k], 'font': {'size': 16}, 'showarrow': False,
+                'xref': 'paper', 'yref': 'paper', 'xanchor': 'center', 'yanchor': 'bottom',
+                'x': (x_domains[col][0] + x_domains[col][1]) / 2.0, 'y': y_domains[row][1],
+            })
+        if k < len(cells):
+            for trace in cells[k]:
+                data.append(dict(trace, xaxis=axis_name('x', index), yaxis=axis_name('y', index)))
+    return {'data': data, 'layout': layout}
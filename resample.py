@@ -0,0 +1,179 @@
+import collections
+import threading
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from dash import Patch, exceptions
+import constants
+import erddap
+import mission_config
+import store
+import downsample
+
+# Dynamic resampling of the time series plots of the mission page. When the user zooms, the
+# traces are replaced, with a figure Patch, by the full resolution data of the visible time range
+# downsampled to the same number of points, so the detail appears as the range narrows. Going back
+# to the full range (autorange) puts the data at the decimation the figure was drawn with back.
+#
+# draw_plots leaves what is needed to find the data of each trace in the plots-traces store:
+#
+#     {'mission_id', 'start_date', 'end_date', 'decimation', 'freq', 'points',
+#      'traces': [{'drone', 'variable'}, ...]}   (in the order of the traces of the figure)
+#
+# Each drone is read once for all of its variables, over the whole time range of the plots when
+# the store has it (a local read), and the zoomed range is cut from that in memory. What the store
+# doesn't have comes from ERDDAP for the zoomed range only. Every process keeps the drone frames it
+# read most recently, up to constants.resample_cache_mb, so zooming and panning around the same
+# plots doesn't read them again. The drones are read at the same time, like draw_plots does.
+#
+# The lines are broken at the gaps in the data only when it is decimated, with freq the interval,
+# again like draw_plots, so going back to the full range gives the figure it drew.
+
+_frames = collections.OrderedDict()
+_frames_bytes = 0
+_frames_lock = threading.Lock()
+
+
+def cached(key):
+    with _frames_lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key][0]
+    return None
+
+
+def remember(key, df):
+    global _frames_bytes
+    size = int(df.memory_usage(deep=True).sum())
+    limit = constants.resample_cache_mb * 1024 * 1024
+    if size <= limit:
+        with _frames_lock:
+            if key not in _frames:
+                _frames[key] = (df, size)
+                _frames_bytes += size
+            while _frames_bytes > limit:
+                _, (_, evicted) = _frames.popitem(last=False)
+                _frames_bytes -= evicted
+    return df
+
+
+def read_drone(mid, d, variables, start_date, end_date, decimation, time_range=None):
+    # The drone's time and variables over the time range of the plots, from the store. When the
+    # store doesn't have them, they come from ERDDAP, and then only for time_range, the part of
+    # the plots in view, so a zoom never waits on a full resolution read of the whole range.
+    key = (mid, d, tuple(variables), start_date, end_date, decimation)
+    df = cached(key)
+    if df is not None:
+        return df
+    columns = ['time'] + [v for v in variables if v != 'time']
+    try:
+        df = store.read_drone(mid, d, columns, start_date, end_date, decimation)
+    except Exception as e:
+        print('Resample: exception reading ' + d + ' from the store, reading from ERDDAP.')
+        print('e=', str(e))
+        df = None
+    if df is not None:
+        return remember(key, df.assign(time=pd.to_datetime(df['time'], utc=True)).sort_values('time', kind='stable'))
+    if time_range is not None:
+        if start_date is None or time_range[0] > store.to_utc(start_date):
+            start_date = erddap.format_time(time_range[0])
+        if end_date is None or time_range[1] < store.to_utc(end_date):
+            end_date = erddap.format_time(time_range[1])
+        key = (mid, d, tuple(variables), start_date, end_date, decimation)
+        df = cached(key)
+        if df is not None:
+            return df
+    url = mission_config.get(mid)['drones'][d]['url']
+    query = '&trajectory="' + d + '"'
+    if decimation > 0:
+        query = query + '&orderByClosest("time/' + str(decimation) + 'hours")'
+    else:
+        query = query + '&orderBy("time")'
+    if start_date is not None:
+        query = query + '&time>=' + erddap.format_time(store.to_utc(start_date))
+    if end_date is not None:
+        query = query + '&time<=' + erddap.format_time(store.to_utc(end_date))
+    try:
+        df = erddap.read_table(url, columns, query, erddap.get_metadata(url)['var_types'])
+    except urllib.error.HTTPError as e:
+        # 404 is ERDDAP for "no data"
+        if e.code != 404:
+            raise
+        df = pd.DataFrame(columns=columns)
+    return remember(key, df.assign(time=pd.to_datetime(df['time'], utc=True)).sort_values('time', kind='stable'))
+
+
+def x_range(relayout_data):
+    # The new time range from relayoutData, None when the x axes went back to autorange.
+    # Raises PreventUpdate when the x axes didn't change (e.g. a y zoom or a legend click).
+    for key, value in relayout_data.items():
+        if key.startswith('xaxis') and key.endswith('.autorange') and value:
+            return None
+    for key, value in relayout_data.items():
+        if key.startswith('xaxis') and key.endswith('.range[0]'):
+            end = relayout_data.get(key.replace('[0]', '[1]'))
+            if end is not None:
+                return pd.Timestamp(value, tz='UTC'), pd.Timestamp(end, tz='UTC')
+        if key.startswith('xaxis') and key.endswith('.range') and isinstance(value, list) and len(value) == 2:
+            return pd.Timestamp(value[0], tz='UTC'), pd.Timestamp(value[1], tz='UTC')
+    raise exceptions.PreventUpdate
+
+
+def trace_values(df, x, y):
+    # x and y of a trace as lists, with None for the NaN of the gaps.
+    xs = df[x].dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object)
+    ys = pd.to_numeric(df[y], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan).astype(object)
+    ys[pd.isna(ys)] = None
+    return xs.tolist(), ys.tolist()
+
+
+def patch(plots_traces, time_range):
+    # A figure Patch with the data of every trace for the time range, or for the whole figure.
+    mid = plots_traces['mission_id']
+    if time_range is None:
+        decimation = plots_traces['decimation']
+        freq = plots_traces['freq']
+    else:
+        decimation = 0
+        freq = None
+    # The variables of each drone, in the order of the traces. draw_plots draws an empty trace
+    # for a drone that doesn't have the variable, and so does this.
+    drones_config = mission_config.get(mid)['drones']
+    drone_variables = {}
+    for trace in plots_traces['traces']:
+        if trace['variable'] not in drones_config[trace['drone']]['variables']:
+            continue
+        drone_variables.setdefault(trace['drone'], [])
+        if trace['variable'] not in drone_variables[trace['drone']]:
+            drone_variables[trace['drone']].append(trace['variable'])
+    drones = list(drone_variables)
+
+    def read(d):
+        return read_drone(mid, d, drone_variables[d], plots_traces['start_date'], plots_traces['end_date'], decimation, time_range)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(constants.plot_fetch_workers, len(drones)))) as pool:
+        frames = dict(zip(drones, pool.map(read, drones)))
+    # The gaps of each variable of each drone, found before downsampling like draw_plots does.
+    gaps = {}
+    for d, df in frames.items():
+        gaps[d] = {}
+        if freq is not None and df.shape[0] > 3:
+            gaps[d] = downsample.gap_ends(df, 'time', drone_variables[d], freq)
+    figure = Patch()
+    for index, trace in enumerate(plots_traces['traces']):
+        if trace['variable'] not in drone_variables.get(trace['drone'], []):
+            figure['data'][index]['x'] = []
+            figure['data'][index]['y'] = []
+            continue
+        df = frames[trace['drone']]
+        ends = gaps[trace['drone']].get(trace['variable'], np.array([], dtype=np.int64))
+        if time_range is not None:
+            df = df[(df['time'] >= time_range[0]) & (df['time'] <= time_range[1])]
+        df = df[['time', trace['variable']]].dropna(subset=[trace['variable']])
+        df = downsample.downsample(df, 'time', trace['variable'], plots_traces['points'])
+        df = downsample.insert_gaps(df, 'time', ends)
+        x, y = trace_values(df, 'time', trace['variable'])
+        figure['data'][index]['x'] = x
+        figure['data'][index]['y'] = y
+    return figure
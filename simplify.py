@@ -0,0 +1,140 @@
+import numpy as np
+import plotly.graph_objects as go
+
+# Drone tracks for the maps are drawn as polylines simplified with Douglas-Peucker to a tolerance
+# in degrees that matches the zoom, plus a marker at each point the simplification kept for hovering.
+# Simplifying only bounds the points of a figure while the map is zoomed out. Closer in, the finer
+# tolerances keep almost every point, so those figures are clipped to the part of the map on the
+# screen (see clip) to keep their size set by the screen rather than by the number of missions.
+
+# Tolerances in degrees, coarsest first. 0 keeps every point.
+tolerances = [0.5, 0.1, 0.02, 0.005, 0.0]
+
+# Points that may be off the simplified line, in screen pixels.
+pixel_tolerance = 2
+
+
+def douglas_peucker(x, y, tolerance):
+    # Mask of the points of the polyline (x, y) to keep so no point is further than tolerance
+    # from the simplified line. The first and last points are always kept.
+    n = x.shape[0]
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = True
+    keep[n - 1] = True
+    if tolerance <= 0:
+        keep[:] = True
+        return keep
+    stack = [(0, n - 1)]
+    while len(stack) > 0:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(px, py)
+        else:
+            distance = np.abs(dx * py - dy * px) / length
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return keep
+
+
+def simplify(df, tolerance, group):
+    # The rows of each track (the rows with the same values of the group columns, in time order)
+    # that Douglas-Peucker keeps at the tolerance.
+    if df.shape[0] == 0 or tolerance <= 0:
+        return df
+    df = df.sort_values(group + ['time'])
+    keep = np.zeros(df.shape[0], dtype=bool)
+    x = df['longitude'].to_numpy(dtype=float)
+    y = df['latitude'].to_numpy(dtype=float)
+    starts = np.flatnonzero(~df[group].duplicated().to_numpy())
+    ends = np.append(starts[1:], df.shape[0])
+    for start, end in zip(starts, ends):
+        keep[start:end] = douglas_peucker(x[start:end], y[start:end], tolerance)
+    return df[keep]
+
+
+def clip(df, bounds, group):
+    # The rows of each track (in time order) inside bounds, [west, south, east, north] in degrees,
+    # along with the rows just before and after them so the lines run off the edge of the map.
+    # The stretches of a track left are numbered in a segment column, to draw them as separate lines.
+    df = df.sort_values(group + ['time'])
+    if bounds is None or df.shape[0] == 0:
+        return df.assign(segment=0)
+    west, south, east, north = bounds
+    lon = df['longitude'].to_numpy(dtype=float)
+    lat = df['latitude'].to_numpy(dtype=float)
+    inside = (lat >= south) & (lat <= north)
+    if east - west < 360:
+        # Measured from the west edge, so a map across the antimeridian works too.
+        inside = inside & (np.mod(lon - west, 360.0) <= east - west)
+    keys = df[group].to_numpy()
+    same = np.ones(df.shape[0] - 1, dtype=bool) if len(group) == 0 else (keys[1:] == keys[:-1]).all(axis=1)
+    keep = inside.copy()
+    keep[1:] |= inside[:-1] & same
+    keep[:-1] |= inside[1:] & same
+    position = np.flatnonzero(keep)
+    segment = np.cumsum(np.append(True, np.diff(position) > 1))
+    return df.iloc[position].assign(segment=segment)
+
+
+def tolerance_for_degrees_per_pixel(degrees):
+    # The coarsest tolerance that stays within pixel_tolerance pixels on the screen.
+    for tolerance in tolerances:
+        if tolerance <= pixel_tolerance * degrees:
+            return tolerance
+    return tolerances[-1]
+
+
+def tolerance_for_zoom(zoom):
+    # Zoom level of a tile map: the world is 256 * 2^zoom pixels wide.
+    return tolerance_for_degrees_per_pixel(360.0 / (256.0 * 2.0 ** float(zoom)))
+
+
+def tolerance_for_extent(df, width=1000):
+    # For a map fit to the locations in df and about width pixels wide.
+    if df.shape[0] == 0:
+        return tolerances[0]
+    span = max(np.ptp(df['longitude'].to_numpy(dtype=float)), np.ptp(df['latitude'].to_numpy(dtype=float)), 1e-6)
+    return tolerance_for_degrees_per_pixel(span / width)
+
+
+def track_traces(df, group, name, hover_data, colors, kind='map'):
+    # One polyline and one set of hover markers for each value of the name column, with one
+    # legend entry. Tracks in group are separated in the polyline by a break in the line.
+    # The markers carry hover_data as customdata, in order.
+    scatter = go.Scattermap if kind == 'map' else go.Scattergeo
+    traces = []
+    for i, (title, named) in enumerate(df.groupby(name, sort=False)):
+        color = colors[i % len(colors)]
+        named = named.sort_values(group + ['time'])
+        # A NaN row after the end of each track so the line is broken there.
+        keys = named[group].to_numpy()
+        track_end = np.append((keys[1:] != keys[:-1]).any(axis=1), True)
+        lon = named['longitude'].to_numpy(dtype=float)
+        lat = named['latitude'].to_numpy(dtype=float)
+        position = np.arange(lon.shape[0]) + np.cumsum(track_end) - track_end
+        line_lon = np.full(lon.shape[0] + int(track_end.sum()), np.nan)
+        line_lat = np.full(line_lon.shape[0], np.nan)
+        line_lon[position] = lon
+        line_lat[position] = lat
+        traces.append(scatter(
+            lon=line_lon, lat=line_lat, mode='lines', name=str(title), legendgroup=str(title),
+            line={'color': color, 'width': 2}, hoverinfo='skip',
+        ))
+        traces.append(scatter(
+            lon=lon, lat=lat, mode='markers', name=str(title), legendgroup=str(title), showlegend=False,
+            marker={'color': color, 'size': 5}, customdata=named[hover_data].astype(str).to_numpy(),
+        ))
+    return traces
@@ -0,0 +1,269 @@
+import os
+import json
+import glob
+import urllib.error
+import numpy as np
+import pandas as pd
+from celery.utils.log import get_task_logger
+import constants
+import erddap
+import mission_config
+
+logger = get_task_logger(__name__)
+
+# A local copy of the full resolution data of every drone, one parquet file per month:
+#
+#     <constants.store_root>/<mission_id>/<drone>/<YYYY-MM>.parquet
+#
+# and of the same months already decimated to each of the sampling choices on the mission page:
+#
+#     <constants.store_root>/<mission_id>/<drone>/<N>h/<YYYY-MM>.parquet
+#
+# The celery workers keep it up to date (see sync_mission) and the mission page reads
+# from it before falling back to ERDDAP. Next to the month files, state.json records how
+# far the drone has been copied, with which variables and which decimation levels.
+#
+# The web processes only read the store and the workers only write it. On Dokku they run in
+# separate containers, so constants.store_root has to be a storage mount shared by the web
+# and worker process types, e.g.
+#
+#     dokku storage:mount <app> /var/lib/dokku/data/storage/<app>/store:/app/store
+#
+# Without it the web side finds no store and every read goes to ERDDAP (and says so in the log).
+
+time_format = erddap.time_format
+
+# Hours between samples for each of the 1 sample/N hours options of the mission page.
+levels = [24, 18, 15, 12, 9, 6, 3]
+
+
+def drone_dir(mid, d):
+    return os.path.join(constants.store_root, mid, d)
+
+
+def level_dir(mid, d, level):
+    return os.path.join(drone_dir(mid, d), str(level) + 'h')
+
+
+def read_state(mid, d):
+    state_file = os.path.join(drone_dir(mid, d), 'state.json')
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def write_atomic(path, write):
+    # Write to a temporary file and move it into place so readers never see a partial file.
+    tmp = path + '.tmp'
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def write_state(mid, d, state):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+    write_atomic(os.path.join(drone_dir(mid, d), 'state.json'), write)
+
+
+def to_utc(value):
+    t = pd.Timestamp(value)
+    if t.tzinfo is None:
+        t = t.tz_localize('UTC')
+    return t.tz_convert('UTC')
+
+
+def epoch_seconds(times):
+    # Independent of the resolution pandas happened to store the times in.
+    return ((times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)).to_numpy()
+
+
+def drone_columns(drone):
+    columns = ['time', 'latitude', 'longitude', 'trajectory']
+    for var in drone['variables']:
+        if var not in columns:
+            columns.append(var)
+    return columns
+
+
+def decimate(df, hours):
+    # The rows ERDDAP's orderByClosest("time/<hours>hours") would return: for each multiple of
+    # the interval, the row with the time closest to it.
+    if hours <= 0 or df.shape[0] == 0:
+        return df
+    df = df[df['time'].notna()]
+    t = epoch_seconds(df['time'])
+    interval = int(hours) * 60 * 60
+    bins = (t + interval // 2) // interval
+    distance = np.abs(t - bins * interval)
+    order = np.lexsort((distance, bins))
+    first = np.ones(order.shape[0], dtype=bool)
+    first[1:] = bins[order][1:] != bins[order][:-1]
+    return df.iloc[np.sort(order[first])]
+
+
+def write_levels(mid, d, month, df):
+    # The decimation pyramid for one month of a drone. A bin that straddles two months
+    # gets a row from each, read_drone keeps the closer one.
+    for level in levels:
+        level_df = decimate(df, level)
+        write_atomic(os.path.join(level_dir(mid, d, level), month + '.parquet'), lambda tmp: level_df.to_parquet(tmp, index=False))
+
+
+def build_levels(mid, d):
+    # Decimate every month already in the store, for stores made before the levels existed or changed.
+    for level in levels:
+        os.makedirs(level_dir(mid, d, level), exist_ok=True)
+    for month_file in sorted(glob.glob(os.path.join(drone_dir(mid, d), '*.parquet'))):
+        month = os.path.basename(month_file)[:-len('.parquet')]
+        write_levels(mid, d, month, pd.read_parquet(month_file))
+
+
+def read_month(drone, d, columns, start, end):
+    # Everything the drone reported in [start, end) at full resolution.
+    query = '&trajectory="' + d + '"&time>=' + start.strftime(time_format) + '&time<' + end.strftime(time_format)
+    logger.debug('Store reading ' + drone['url'] + ' ' + query)
+    try:
+        df = erddap.read_table(drone['url'], columns, query, erddap.get_metadata(drone['url'])['var_types'])
+    except urllib.error.HTTPError as e:
+        # 404 is ERDDAP for "no data"
+        if e.code != 404:
+            raise
+        return None
+    df['trajectory'] = df['trajectory'].astype(str)
+    return df
+
+
+def sync_drone(mid, d, drone):
+    # Copy whatever ERDDAP has for the drone that the store doesn't, one month at a time.
+    # The month holding the last copied time is re-read from that time and merged.
+    if 'variables' not in drone or 'end_date' not in drone:
+        return 0
+    columns = drone_columns(drone)
+    state = read_state(mid, d)
+    if state is not None and state['columns'] != columns:
+        # The variables changed, start over so every month has the same columns.
+        logger.info('Variables changed for ' + mid + '/' + d + ', copying it again.')
+        for month_file in glob.glob(os.path.join(drone_dir(mid, d), '*.parquet')) + glob.glob(os.path.join(drone_dir(mid, d), '*h', '*.parquet')):
+            os.remove(month_file)
+        state = None
+    if state is not None and state.get('levels') != levels:
+        build_levels(mid, d)
+        state['levels'] = levels
+        write_state(mid, d, state)
+    end = to_utc(drone['end_date'])
+    if state is not None:
+        last = to_utc(state['end'])
+        if last >= end:
+            return 0
+        start = last
+    else:
+        start = to_utc(drone['start_date'])
+    os.makedirs(drone_dir(mid, d), exist_ok=True)
+    for level in levels:
+        os.makedirs(level_dir(mid, d, level), exist_ok=True)
+    rows = 0
+    month = start.tz_convert(None).to_period('M')
+    while month.start_time.tz_localize('UTC') <= end:
+        month_start = max(start, month.start_time.tz_localize('UTC'))
+        month_end = (month + 1).start_time.tz_localize('UTC')
+        df = read_month(drone, d, columns, month_start, month_end)
+        month_file = os.path.join(drone_dir(mid, d), str(month) + '.parquet')
+        if df is not None and df.shape[0] > 0:
+            if os.path.exists(month_file):
+                df = pd.concat([pd.read_parquet(month_file), df])
+                df = df.drop_duplicates(subset=['time'], keep='last')
+            df = df.sort_values('time')
+            write_atomic(month_file, lambda tmp: df.to_parquet(tmp, index=False))
+            write_levels(mid, d, str(month), df)
+            rows = rows + df.shape[0]
+            last_time = df['time'].max()
+        else:
+            last_time = min(month_end, end)
+        # Record progress after every month so an interrupted sync picks up where it stopped.
+        write_state(mid, d, {'columns': columns, 'end': to_utc(last_time).strftime(time_format), 'levels': levels})
+        month = month + 1
+    return rows
+
+
+def sync_mission(mid, mission):
+    # Bring every drone of the mission up to date. Drones already copied up to their end_date,
+    # which is every drone of a finished mission, cost nothing.
+    lock = constants.redis_instance.lock('store_sync:' + mid, timeout=constants.store_task_timeout + 60)
+    if not lock.acquire(blocking=False):
+        logger.info('Store sync for ' + mid + ' is already running.')
+        return 0
+    try:
+        rows = 0
+        for d in mission['drones']:
+            rows = rows + sync_drone(mid, d, mission['drones'][d])
+        return rows
+    finally:
+        lock.release()
+
+
+def read_months(directory, columns, start, end):
+    frames = []
+    for month_file in sorted(glob.glob(os.path.join(directory, '*.parquet'))):
+        month = pd.Period(os.path.basename(month_file)[:-len('.parquet')], freq='M')
+        if start is not None and month.end_time.tz_localize('UTC') < start:
+            continue
+        if end is not None and month.start_time.tz_localize('UTC') > end:
+            continue
+        frames.append(pd.read_parquet(month_file, columns=columns))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+_missing_logged = False
+
+
+def is_covered(mid, d, state, end):
+    # Whether the store has copied the drone up to end, or up to the drone's end_date when end
+    # is None. During the first sync, or after an interrupted one, it hasn't.
+    drone_end = None
+    mission = mission_config.get(mid)
+    if mission is not None and d in mission['drones'] and 'end_date' in mission['drones'][d]:
+        drone_end = to_utc(mission['drones'][d]['end_date'])
+    if end is None or (drone_end is not None and drone_end < end):
+        end = drone_end
+    if end is None:
+        return False
+    return to_utc(state['end']) >= end
+
+
+def read_drone(mid, d, columns, start_date=None, end_date=None, decimation=0):
+    # The drone's data from the store, or None when the store doesn't have the drone or hasn't
+    # copied it as far as end_date yet (so the caller should go to ERDDAP). Times are UTC,
+    # like read_csv(parse_dates=['time']) of ERDDAP csv.
+    # The decimation levels the store keeps are read already decimated, any other is done here.
+    global _missing_logged
+    if not os.path.isdir(constants.store_root):
+        if not _missing_logged:
+            logger.warning('No drone store at ' + os.path.abspath(constants.store_root) + ', reading from ERDDAP.')
+            _missing_logged = True
+        return None
+    state = read_state(mid, d)
+    if state is None:
+        return None
+    if any(c not in state['columns'] for c in columns):
+        return None
+    read_columns = list(dict.fromkeys(['time'] + list(columns)))
+    start = to_utc(start_date) if start_date is not None else None
+    end = to_utc(end_date) if end_date is not None else None
+    if not is_covered(mid, d, state, end):
+        logger.info('Store has ' + mid + '/' + d + ' up to ' + state['end'] + ' only, reading from ERDDAP.')
+        return None
+    directory = drone_dir(mid, d)
+    if decimation > 0 and decimation in state.get('levels', []):
+        directory = level_dir(mid, d, decimation)
+    df = read_months(directory, read_columns, start, end)
+    df['time'] = pd.to_datetime(df['time'], utc=True)
+    if start is not None:
+        df = df[df['time'] >= start]
+    if end is not None:
+        df = df[df['time'] <= end]
+    df = decimate(df, decimation)
+    return df[list(columns)].reset_index(drop=True)
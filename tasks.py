@@ -3,15 +3,22 @@ import redis
 import pandas as pd
 import numpy as np
 import json
+import io
+import datetime
 from celery import Celery
-from sdig.erddap.info import Info
 import urllib.parse
 import constants
 import db
 from celery.utils.log import get_task_logger
 import ssl
 import urllib.parse
+import urllib.error
 import plotly.express as px
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, DateTime
+import erddap
+import mission_config
+import overview
 
 ssl._create_default_https_context = ssl._create_unverified_context
 logger = get_task_logger(__name__)
@@ -21,10 +28,121 @@ def flush():
     constants.redis_instance.flushall()
 
 
-def update_mission(mid, mission):
+def watermark_key(mid, trajectory):
+    return mid + '/' + str(trajectory)
+
+
+def get_watermarks():
+    # Last location time loaded into postgres for each mission_id/trajectory
+    watermarks = constants.redis_instance.hgetall('watermarks')
+    return {k.decode('utf-8'): v.decode('utf-8') for k, v in watermarks.items()}
+
+
+def window_start(watermark):
+    # orderByClosest("time,1day") keeps the row closest to each midnight, and the row kept for
+    # the most recent day can still change while the drone is reporting. Re-read everything from
+    # the start of that day's interval (12 hours before the nearest midnight) so that an
+    # incremental load ends up with exactly the rows a full pull would have.
+    center = pd.Timestamp(watermark).tz_convert(None).round('1D')
+    return (center - pd.Timedelta(hours=12)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def is_loaded(watermarks, mid, d, end_date):
+    # Whether the locations committed to postgres for the drone reach end_date, that is the last
+    # row loaded is the one orderByClosest("time,1day") keeps for the day of end_date (see window_start).
+    # The mission JSON is stored before the locations are published, so it can't tell on its own.
+    key = watermark_key(mid, d)
+    if watermarks is None or key not in watermarks or end_date is None:
+        return False
+    loaded = pd.to_datetime(watermarks[key], utc=True).tz_convert(None).round('1D')
+    return loaded >= pd.to_datetime(end_date, utc=True).tz_convert(None).round('1D')
+
+
+def is_unchanged(previous, watermarks, mid, d, drone, start_date, end_date):
+    # The drone's time range is the cheap signal that its dataset has changed, as long as
+    # the last run got as far as committing the locations for that range.
+    if previous is None or 'dsg_id' not in previous:
+        return False
+    prev = previous['drones'].get(d)
+    if prev is None or 'variables' not in prev:
+        return False
+    if prev.get('url') != drone['url'] or prev.get('start_date') != start_date or prev.get('end_date') != end_date:
+        return False
+    return is_loaded(watermarks, mid, d, end_date)
+
+
+def read_drone(mid, mission, d, color, since=None, previous=None, refresh=False, watermarks=None):
+    # Everything ingest needs from ERDDAP for one drone: time range, metadata and daily locations.
+    # Each request waits for a slot on its ERDDAP server so concurrent reads stay polite.
+    # With the mission as stored by the last run in previous, a drone whose time range has
+    # not moved, and whose locations were committed up to its end (per watermarks), reuses
+    # that metadata and its locations are not read again. Metadata otherwise
+    # comes from the cache in erddap.py unless refresh is set.
+    logger.debug('Reading drone ' + str(d))
+    drone = mission['drones'][d]
+    print("time range:", drone['url'])
+    tdf = erddap.read_table(drone['url'], ['time'], '&orderByMinMax("time")')
+    start_date = erddap.format_time(tdf['time'].min())
+    end_date = erddap.format_time(tdf['time'].max())
+    if is_unchanged(previous, watermarks, mid, d, drone, start_date, end_date):
+        logger.debug('No new data for drone ' + str(d))
+        drone_vars = previous['drones'][d]['variables']
+        return {
+            'df': None,
+            'variables': drone_vars,
+            'start_date': start_date,
+            'end_date': end_date,
+            'color': color,
+            'dsg_id': previous['dsg_id'],
+            'long_names': {v: previous['long_names'][v] for v in drone_vars if v in previous['long_names']},
+            'units': {v: previous['units'][v] for v in drone_vars if v in previous['units']},
+        }
+    metadata = erddap.get_metadata(drone['url'], refresh=refresh)
+    dsg_var = metadata['dsg_var']
+    dsg_id = dsg_var[metadata['dsg_type']]
+    drone_vars = metadata['variables']
+    d_long_names = metadata['long_names']
+    d_units = metadata['units']
+    req_vars = ['latitude', 'longitude', 'time', dsg_id]
+    query = '&orderByClosest("time,1day")&'+dsg_id+'="'+d+'"'
+    if since is not None:
+        query = query + '&time>=' + since
+    print("Locations:", drone['url'], query)
+    try:
+        df = erddap.read_table(drone['url'], req_vars, query, metadata['var_types'])
+    except urllib.error.HTTPError as e:
+        # ERDDAP answers 404 when nothing matches, which for an incremental read just means no new rows.
+        if since is None or e.code != 404:
+            raise
+        df = pd.DataFrame(columns=req_vars)
+    # The locations table keeps ERDDAP's time strings.
+    df['time'] = erddap.time_strings(df['time'])
+    # Don't drop, just take the rows where lat or lon is not NA:
+    df = df[df['latitude'].notna()]
+    df = df[df['longitude'].notna()]
+    df['mission_id'] = mid
+    df['title'] = mission['ui']['title']
+    df[dsg_id] = df[dsg_id].astype(str)
+    return {
+        'df': df,
+        'variables': drone_vars,
+        'start_date': start_date,
+        'end_date': end_date,
+        'color': color,
+        'dsg_id': dsg_var['trajectory'],
+        'long_names': d_long_names,
+        'units': d_units,
+    }
+
+
+def update_mission(mid, mission, workers=None, since=None, previous=None, refresh=False, watermarks=None):
    
     logger.debug('Pulling locations for mission ' + str(mission['ui']['title']))
-         
+
+    if workers is None:
+        workers = constants.ingest_workers
+    if since is None:
+        since = {}
     start_dates = []
     end_dates = []
     long_names = {}
@@ -32,43 +150,34 @@ def update_mission(mid, mission):
     dsg_ids = []
     drones = mission['drones']
     mission_dfs = []
-    for dix, d in enumerate(sorted(drones)):
-        color = px.colors.qualitative.Alphabet[dix]
-        logger.debug('Reading drone ' + str(d))
-        drone = drones[d]
-        info = Info(drone['url']) 
-        depth_name, dsg_var = info.get_dsg_info()
-        dsg_id = dsg_var[info.get_dsg_type()]
-        base_url = drone['url'] + '.csv?'
-        time_url = base_url + urllib.parse.quote_plus('time&orderByMinMax("time")')
-        print("time range:", time_url)
-        tdf = pd.read_csv(time_url, skiprows=[1])
-        start_date = tdf['time'].min()
-        end_date = tdf['time'].max()
-        req_vars = 'latitude,longitude,time,' + dsg_id
-        query = '&orderByClosest("time,1day")&'+dsg_id+'="'+d+'"'
-        q = urllib.parse.quote(query)
-        url = base_url + req_vars + q
-        print("Locations:", url)
-        df = pd.read_csv(url, skiprows=[1])
-        # Don't drop, just take the rows where lat or lon is not NA:
-        df = df[df['latitude'].notna()]
-        df = df[df['longitude'].notna()]
-        df['mission_id'] = mid
-        df['title'] = mission['ui']['title']
-        df[dsg_id] = df[dsg_id].astype(str)
-        drone_vars, d_long_names, d_units, standard_names, var_types = info.get_variables()
-        drones[d]['variables'] = drone_vars
-        drones[d]['start_date'] = start_date
-        drones[d]['color'] = color
-        start_dates.append(start_date)
-        drones[d]['end_date'] = end_date
-        end_dates.append(end_date)
-        depth_name, dsg_id = info.get_dsg_info()
-        dsg_ids.append(dsg_id['trajectory'])
-        long_names = {**long_names, **d_long_names}
-        units = {**units, **d_units}
-        mission_dfs.append(df)
+    unchanged = []
+    drone_ids = sorted(drones)
+    colors = [px.colors.qualitative.Alphabet[dix] for dix in range(len(drone_ids))]
+    if workers > 1 and len(drone_ids) > 1:
+        # The drones are independent, so read them at the same time. map() returns the results
+        # in drone order, so the mission is assembled exactly as it is when reading serially.
+        pool = ThreadPoolExecutor(max_workers=min(workers, len(drone_ids)))
+        try:
+            results = list(pool.map(lambda d, color: read_drone(mid, mission, d, color, since.get(d), previous, refresh, watermarks), drone_ids, colors))
+        finally:
+            # Don't wait on the remaining drones if we were interrupted (e.g. by a task time limit).
+            pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        results = [read_drone(mid, mission, d, color, since.get(d), previous, refresh, watermarks) for d, color in zip(drone_ids, colors)]
+    for d, result in zip(drone_ids, results):
+        drones[d]['variables'] = result['variables']
+        drones[d]['start_date'] = result['start_date']
+        drones[d]['color'] = result['color']
+        start_dates.append(result['start_date'])
+        drones[d]['end_date'] = result['end_date']
+        end_dates.append(result['end_date'])
+        dsg_ids.append(result['dsg_id'])
+        long_names = {**long_names, **result['long_names']}
+        units = {**units, **result['units']}
+        if result['df'] is None:
+            unchanged.append(d)
+        else:
+            mission_dfs.append(result['df'])
     uids = list(set(dsg_ids))
     if len(uids) == 1:
         mission['dsg_id'] = uids[0]
@@ -81,29 +190,326 @@ def update_mission(mid, mission):
     end_dates.sort()
     mission['start_date'] = start_dates[0]
     mission['end_date'] = end_dates[-1]
-    constants.redis_instance.hset("mission", mid, json.dumps(mission)) 
-    full_df = pd.concat(mission_dfs).reset_index()
-    return full_df
+    mission_config.put(mid, mission)
+    if len(mission_dfs) == 0:
+        return pd.DataFrame(), unchanged
+    full_df = pd.concat(mission_dfs).reset_index(drop=True)
+    return full_df, unchanged
 
-# Run this once from the workspace before deploying the application
 
-def load_missions():
+def read_collections():
     with open('config/missions.json') as missions_config:
         config_json = json.load(missions_config)
-    collections = config_json['collections']
-    outeridx = 0 
+    return config_json['collections']
+
+
+def list_missions():
+    collections = read_collections()
+    missions = []
     for collection in collections:
-        logger.info('Processing missions for ' + collection)
         member = collections[collection]     
-        for idx, mid in enumerate(member['missions']):
-            mission = member['missions'][mid]
-            df = update_mission(mid, mission)
-            if outeridx == 0:
-                locations_df = df
+        for mid in member['missions']:
+            missions.append((mid, member['missions'][mid]))
+    return missions
+
+
+def is_full_load(incremental=True):
+    # In incremental mode each drone only asks ERDDAP for rows at or after its watermark.
+    # Without a table or watermarks to go on, everything is read and the table is rebuilt.
+    if not incremental:
+        return True
+    inspector = inspect(db.engine())
+    if not inspector.has_table(constants.locations_table):
+        return True
+    # A table from before time was stored as a timestamp is rebuilt with the current schema.
+    for column in inspector.get_columns(constants.locations_table):
+        if column['name'] == 'time' and not isinstance(column['type'], DateTime):
+            return True
+    return len(get_watermarks()) == 0
+
+
+def is_frozen(previous, mission, watermarks, mid):
+    # A mission whose data ended long ago is not going to change, so once it has been loaded
+    # there is nothing to ask ERDDAP. A change to its list of drones thaws it, and so does a
+    # drone whose locations were never committed up to its end.
+    if previous is None or 'end_date' not in previous:
+        return False
+    if set(previous['drones']) != set(mission['drones']):
+        return False
+    for d in mission['drones']:
+        if previous['drones'][d].get('url') != mission['drones'][d]['url']:
+            return False
+        if not is_loaded(watermarks, mid, d, previous['drones'][d].get('end_date')):
+            return False
+    end_date = pd.Timestamp(previous['end_date'])
+    return end_date < pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=constants.freeze_after_days)
+
+
+def ingest_mission(mid, mission, full, workers=None, force=False):
+    # Read one mission and return its locations in a form that can travel through the Celery
+    # result backend. Errors are reported rather than raised so that one failing mission or
+    # ERDDAP server does not stop the rest of the missions from being published.
+    # Unless this is a full load or force is set, frozen missions and unchanged drones are skipped.
+    try:
+        previous = None
+        watermarks = {}
+        if not full:
+            watermarks = get_watermarks()
+        if not full and not force:
+            previous = mission_config.load(mid)
+        if is_frozen(previous, mission, watermarks, mid):
+            logger.debug('Mission ' + mid + ' is frozen.')
+            # Still pick up any edits to the mission configuration.
+            for key in mission:
+                if key != 'drones':
+                    previous[key] = mission[key]
+            for d in mission['drones']:
+                previous['drones'][d].update(mission['drones'][d])
+            mission_config.put(mid, previous)
+            return {'mission_id': mid, 'ok': True, 'frozen': True, 'windows': [], 'locations': None}
+        since = {}
+        if not full:
+            for d in mission['drones']:
+                key = watermark_key(mid, d)
+                if key in watermarks:
+                    since[d] = window_start(watermarks[key])
+        df, unchanged = update_mission(mid, mission, workers=workers, since=since, previous=previous, refresh=force, watermarks=watermarks)
+        windows = []
+        if not full:
+            windows = [[d, since.get(d)] for d in mission['drones'] if d not in unchanged]
+        return {'mission_id': mid, 'ok': True, 'frozen': False, 'windows': windows, 'locations': df.to_json(orient='split', index=False)}
+    except Exception as e:
+        logger.exception('Failed to update mission ' + mid)
+        return {'mission_id': mid, 'ok': False, 'error': repr(e)}
+
+
+# Column types of the locations table. Every mission's frame is written in this column order.
+# The ISO 8601 time strings of the frames are parsed by COPY into real timestamps.
+location_columns = {
+    'latitude': 'double precision',
+    'longitude': 'double precision',
+    'time': 'timestamp with time zone',
+    'trajectory': 'text',
+    'mission_id': 'text',
+    'title': 'text',
+}
+# The mission page reads one mission at a time, for some of its drones over a time range.
+location_indexes = {
+    'mission_trajectory_time_idx': '(mission_id, trajectory, time)',
+}
+
+
+def copy_frame(cursor, table, df):
+    # Bulk load with COPY rather than to_sql's row-by-row INSERTs.
+    if df.shape[0] == 0:
+        return
+    columns = list(location_columns)
+    buffer = io.StringIO()
+    df[columns].to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.execute('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table, ','.join(columns)), stream=buffer)
+
+
+def swap_locations(frames, keep_missions):
+    # Build a complete new locations table beside the live one and swap it in, all in one
+    # transaction. Readers see the old table until the commit and the new one after it.
+    # Rows of the missions in keep_missions are carried over from the live table.
+    live = constants.locations_table
+    stage = live + '_stage'
+    old = live + '_old'
+    conn = db.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(stage))
+        cursor.execute('CREATE TABLE {} ({})'.format(stage, ', '.join(c + ' ' + t for c, t in location_columns.items())))
+        for df in frames:
+            copy_frame(cursor, stage, df)
+        if len(keep_missions) > 0:
+            cursor.execute("SELECT to_regclass(%s)", (live,))
+            if cursor.fetchone()[0] is not None:
+                # The casts carry the rows over from a live table with an older schema too.
+                columns = ','.join(location_columns)
+                casts = ','.join('CAST({} AS {})'.format(c, t) for c, t in location_columns.items())
+                cursor.execute('INSERT INTO {} ({}) SELECT {} FROM {} WHERE mission_id IN ({})'
+                               .format(stage, columns, casts, live, ','.join(['%s'] * len(keep_missions))), tuple(keep_missions))
+        for name, columns in location_indexes.items():
+            cursor.execute('CREATE INDEX {}_{} ON {} {}'.format(stage, name, stage, columns))
+        cursor.execute('ANALYZE {}'.format(stage))
+        cursor.execute('ALTER TABLE IF EXISTS {} RENAME TO {}'.format(live, old))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(stage, live))
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(old))
+        for name in location_indexes:
+            cursor.execute('ALTER INDEX {}_{} RENAME TO {}_{}'.format(stage, name, live, name))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def upsert_locations(frames, windows, listed):
+    # Replace only the re-read part of each trajectory, in one transaction, so readers
+    # never see the table without the rows that were there before. The rows of missions and
+    # drones no longer in the config (not among the (mission_id, trajectory) pairs in listed)
+    # go in the same transaction, as a full load would drop them. Returns the pairs removed.
+    conn = db.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT mission_id, trajectory FROM {}'.format(constants.locations_table))
+        removed = [(mid, trajectory) for mid, trajectory in cursor.fetchall() if (mid, trajectory) not in listed]
+        for mid, trajectory in removed:
+            cursor.execute('DELETE FROM {} WHERE mission_id = %s AND trajectory = %s'.format(constants.locations_table),
+                           (mid, trajectory))
+        for (mid, trajectory), since in windows.items():
+            if since is None:
+                cursor.execute('DELETE FROM {} WHERE mission_id = %s AND trajectory = %s'.format(constants.locations_table),
+                               (mid, trajectory))
+            else:
+                cursor.execute('DELETE FROM {} WHERE mission_id = %s AND trajectory = %s AND time >= CAST(%s AS timestamptz)'.format(constants.locations_table),
+                               (mid, trajectory, since))
+        for df in frames:
+            copy_frame(cursor, constants.locations_table, df)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return removed
+
+
+def remove_watermarks(listed):
+    # Forget the watermarks of missions and drones no longer in the config.
+    stale = [key for key in get_watermarks() if key not in {watermark_key(mid, d) for mid, d in listed}]
+    if len(stale) > 0:
+        constants.redis_instance.hdel('watermarks', *stale)
+
+
+def set_watermarks(frames, full):
+    if full:
+        constants.redis_instance.delete('watermarks')
+    mapping = {}
+    for df in frames:
+        latest = df.groupby(['mission_id', 'trajectory'])['time'].max()
+        for (mid, trajectory), t in latest.items():
+            mapping[watermark_key(mid, trajectory)] = t
+    if len(mapping) > 0:
+        constants.redis_instance.hset('watermarks', mapping=mapping)
+
+
+def publish_locations(results, full):
+    # Combine the per-mission results into the locations table and record what happened.
+    frames = []
+    windows = {}
+    succeeded = []
+    frozen = []
+    failed = {}
+    for result in results:
+        if result['ok']:
+            succeeded.append(result['mission_id'])
+            if result['frozen']:
+                frozen.append(result['mission_id'])
+                continue
+            df = pd.read_json(io.StringIO(result['locations']), orient='split', dtype=False, convert_dates=False)
+            if df.shape[0] > 0:
+                frames.append(df)
+            for d, since in result['windows']:
+                windows[(result['mission_id'], d)] = since
+        else:
+            failed[result['mission_id']] = result['error']
+            logger.warning('Mission ' + result['mission_id'] + ' was not updated: ' + result['error'])
+
+    rows = sum(df.shape[0] for df in frames)
+    generation = None
+    if full:
+        if len(frames) > 0:
+            # Keep whatever we already had for the missions that failed this time.
+            logger.info('Setting ' + str(rows) + ' mission locations...')
+            swap_locations(frames, list(failed))
+            set_watermarks(frames, full)
+            generation = db.bump_generation()
+    else:
+        listed = {(mid, d) for mid, mission in list_missions() for d in mission['drones']}
+        logger.info('Adding ' + str(rows) + ' new mission locations...')
+        removed = upsert_locations(frames, windows, listed)
+        if len(removed) > 0:
+            logger.info('Removed the locations of ' + str(len(removed)) + ' drones no longer configured.')
+        remove_watermarks(listed)
+        if len(windows) > 0 or len(removed) > 0:
+            set_watermarks(frames, full)
+            generation = db.bump_generation()
+
+    if len(succeeded) > 0:
+        set_location_summaries(succeeded)
+
+    if generation is None and not overview.is_rendered():
+        # Nothing changed but there is no map yet, e.g. the first run after deploying.
+        generation = db.generation()
+    if generation is not None:
+        # The home page map is drawn once here rather than on every visit.
+        try:
+            overview.render(generation)
+        except Exception:
+            logger.exception('Failed to draw the overview map')
+
+    report = {
+        'finished': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'full': full,
+        'succeeded': succeeded,
+        'frozen': frozen,
+        'failed': failed,
+    }
+    constants.redis_instance.hset('ingest', 'report', json.dumps(report))
+    logger.info('Updated ' + str(len(succeeded)) + ' missions (' + str(len(frozen)) + ' frozen), ' + str(len(failed)) + ' failed.')
+    return report
+
+
+def summarize_locations(df):
+    return {
+        'start_date': erddap.format_time(df['start_date'].min()),
+        'end_date': erddap.format_time(df['end_date'].max()),
+        'rows': int(df['row_count'].sum()),
+        'bbox': [float(df['west'].min()), float(df['south'].min()), float(df['east'].max()), float(df['north'].max())],
+    }
+
+
+def set_location_summaries(mission_ids):
+    # Store what the mission page needs to know about the locations of each mission and each of
+    # its drones (time extent, rows, bounding box as [west, south, east, north]) in the mission
+    # JSON, so the page can be drawn without reading the locations.
+    summary = db.get_location_summary(mission_ids)
+    for mid in mission_ids:
+        mission = mission_config.load(mid)
+        if mission is None:
+            continue
+        mission_summary = summary.loc[summary['mission_id'] == mid]
+        if mission_summary.shape[0] == 0:
+            mission['locations'] = {'rows': 0}
+        else:
+            mission['locations'] = summarize_locations(mission_summary)
+        for d in mission['drones']:
+            drone_summary = mission_summary.loc[mission_summary['trajectory'] == d]
+            if drone_summary.shape[0] == 0:
+                mission['drones'][d]['locations'] = {'rows': 0}
             else:
-                locations_df = pd.concat([locations_df, df])
-            outeridx = outeridx + 1
-                
-    logger.info('Setting the mission locations...')
-    locations_df.to_sql(constants.locations_table, constants.postgres_engine, if_exists='replace', index=False)  
+                mission['drones'][d]['locations'] = summarize_locations(drone_summary)
+        mission_config.put(mid, mission)
+
+
+# Run this once from the workspace before deploying the application
+
+def load_missions(incremental=True, force=False):
+    # The same work the periodic Celery job fans out, done in this process.
+    full = is_full_load(incremental)
+    jobs = list_missions()
 
+    # Missions are read at the same time as well as their drones. The per-host slots in
+    # erddap.py are what actually bound the load on each ERDDAP server.
+    workers = constants.ingest_workers
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda job: ingest_mission(job[0], job[1], full, force=force), jobs))
+    else:
+        results = [ingest_mission(mid, mission, full, force=force) for mid, mission in jobs]
+    return publish_locations(results, full)